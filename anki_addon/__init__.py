@@ -10,3 +10,5 @@ This addon was created to grab and parse definitions from the
 License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
 '''
 from . import jisho_scraper
+from . import batch_fill
+from . import prefetch
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+'''
+Addon: Daijirin Definition Scraper
+Copyright: (c) Jesse Barkdoll 2017-2019 <https://github.com/barkdoll>
+
+Browser action that fills a field of every selected note with the
+definition of the term in another field.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+from aqt import mw
+from aqt.utils import showInfo
+from anki.hooks import addHook
+from anki.utils import stripHTML
+from aqt.qt import *
+
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+
+from .jisho_config import jisho_config
+from .jisho_scraper import iconPath, ScraperWindow
+from .scraper import iter_lookups, FOUND, NOT_FOUND, NOT_FOUND_CACHED
+
+# Terms looked up at the same time. How fast requests actually go out
+# is up to the shared rate limiter, same as for every other lookup.
+BATCH_JOBS = 3
+
+
+class BatchFillWorker(QThread):
+    progress = pyqtSignal(int)
+
+    def __init__(self, items, jisho, parent):
+        super().__init__(parent)
+        # (note id, term) pairs
+        self.items = items
+        self.jisho = jisho
+        self.cancelled = False
+        self.filled = {}
+        self.not_found = 0
+        self.failed = 0
+
+    def run(self):
+        # No one is around to pick between headings, so the first
+        # heading is used for those pages
+        terms = [term for nid, term in self.items]
+        lookups = iter_lookups(
+            terms, self.jisho, concurrency=BATCH_JOBS, ordered=True
+        )
+        try:
+            for i, result in enumerate(lookups):
+                if result.status == FOUND:
+                    self.filled[self.items[i][0]] = result.html
+                elif result.status in (NOT_FOUND, NOT_FOUND_CACHED):
+                    self.not_found += 1
+                else:
+                    self.failed += 1
+                self.progress.emit(i + 1)
+                if self.cancelled:
+                    break
+        finally:
+            lookups.close()
+
+
+class BatchFillDialog(QDialog):
+    def __init__(self, browser):
+        super().__init__(browser)
+        self.browser = browser
+        self.nids = browser.selectedNotes()
+        self.worker = None
+
+        self.setWindowIcon(QIcon(iconPath()))
+        self.setWindowTitle('Fill 辞書 definitions')
+
+        font = ScraperWindow.setupFont(self)
+        self.setFont(font)
+
+        if not self.nids:
+            showInfo('Select the notes to fill first.')
+            return
+
+        fields = [
+            f['name'] for f in mw.col.getNote(self.nids[0]).model()['flds']
+        ]
+
+        self.source = QComboBox()
+        self.source.addItems(fields)
+        self.target = QComboBox()
+        self.target.addItems(fields)
+        if len(fields) > 1:
+            self.target.setCurrentIndex(1)
+
+        self.jisho_select = QComboBox()
+        self.jisho_select.addItems(
+            [value['name'] for key, value in jisho_config.items()]
+        )
+
+        self.overwrite = QCheckBox('Replace definitions already filled in')
+
+        form = QFormLayout()
+        form.addRow('Term field', self.source)
+        form.addRow('Definition field', self.target)
+        form.addRow('Dictionary', self.jisho_select)
+        form.addRow(self.overwrite)
+
+        self.progress = QProgressBar()
+        self.progress.hide()
+
+        self.start_btn = QPushButton(u' 開始 ')
+        self.start_btn.clicked.connect(self.onStart)
+        self.cancel_btn = QPushButton(u' 中止 ')
+        self.cancel_btn.clicked.connect(self.onCancel)
+
+        hl = QHBoxLayout()
+        hl.addWidget(self.progress)
+        hl.addWidget(self.start_btn)
+        hl.addWidget(self.cancel_btn)
+
+        vl = QVBoxLayout()
+        vl.addWidget(QLabel('{} notes selected'.format(len(self.nids))))
+        vl.addLayout(form)
+        vl.addLayout(hl)
+        self.setLayout(vl)
+
+        self.show()
+
+    def onStart(self):
+        source = self.source.currentText()
+        target = self.target.currentText()
+        jisho = list(jisho_config)[self.jisho_select.currentIndex()]
+
+        items = []
+        for nid in self.nids:
+            note = mw.col.getNote(nid)
+            if source not in note or target not in note:
+                continue
+            if note[target].strip() and not self.overwrite.isChecked():
+                continue
+            term = stripHTML(note[source]).strip()
+            if term:
+                items.append((nid, term))
+
+        if not items:
+            showInfo('There are no notes to fill.')
+            return
+
+        self.target_field = target
+        self.start_btn.setEnabled(False)
+        self.progress.setRange(0, len(items))
+        self.progress.setValue(0)
+        self.progress.show()
+
+        self.worker = BatchFillWorker(items, jisho, self)
+        self.worker.progress.connect(self.progress.setValue)
+        self.worker.finished.connect(self.onDone)
+        self.worker.start()
+
+    def onCancel(self):
+        if self.worker is None:
+            self.close()
+            return
+        # Definitions found so far are still written
+        self.worker.cancelled = True
+        self.setWindowTitle('Cancelling...')
+
+    def onDone(self):
+        worker = self.worker
+        self.worker = None
+
+        # All notes are written in one go behind a single undo point
+        mw.checkpoint('Fill 辞書 definitions')
+        mw.progress.start(immediate=True)
+        try:
+            for nid, html in worker.filled.items():
+                note = mw.col.getNote(nid)
+                note[self.target_field] = html
+                note.flush()
+            mw.col.save()
+        finally:
+            mw.progress.finish()
+
+        self.browser.model.reset()
+        mw.requireReset()
+
+        showInfo(
+            'Filled {0} notes. {1} terms were not found and {2} could '
+            'not be looked up.'.format(
+                len(worker.filled), worker.not_found, worker.failed)
+        )
+        self.close()
+
+    # Stops a running batch before the window goes away
+    def closeEvent(self, event):
+        if self.worker is not None:
+            self.worker.cancelled = True
+            event.ignore()
+            return
+        super().closeEvent(event)
+
+
+def setupBrowserMenu(browser):
+    action = QAction('Fill 辞書 definitions...', browser)
+    action.triggered.connect(lambda: BatchFillDialog(browser))
+    browser.form.menuEdit.addSeparator()
+    browser.form.menuEdit.addAction(action)
+
+
+addHook('browser.setupMenus', setupBrowserMenu)
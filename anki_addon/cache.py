@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+'''
+Persistent on-disk cache of weblio pages.
+
+Pages are kept in a SQLite file in the user's data directory, keyed by
+the term and the dictionary's url_id. Fresh pages are served without
+touching the network; stale ones are revalidated with ETag /
+Last-Modified. Once the cache grows past its size cap the least
+recently used pages are evicted.
+
+A second table keeps the parsed result of each page, stamped with the
+parser version that produced it, so a repeat lookup needs neither the
+network nor BeautifulSoup. Results from an older parser are ignored
+and re-derived from the cached page.
+
+Terms whose page had no entry in the dictionary are remembered in a
+third table for a shorter time (`miss_ttl`), so misspellings and
+inflected forms that keep coming back don't cost a fetch every time.
+purge_misses() forgets them early.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import json
+import os
+import sys
+import sqlite3
+import threading
+import time
+import unicodedata
+
+try:
+    from . import metrics
+    from . import session
+except ImportError:
+    import metrics
+    import session
+
+settings = {
+    'enabled': True,
+    # Defaults to cache.sqlite inside data_dir()
+    'path': None,
+    # Seconds a page is served without asking weblio if it changed
+    'ttl': 7 * 24 * 60 * 60,
+    # Seconds a term with no entry is answered as not found without
+    # looking again
+    'miss_ttl': 24 * 60 * 60,
+    # Total size of the cached pages before LRU eviction kicks in
+    'max_bytes': 200 * 1024 * 1024,
+}
+
+_db = None
+_db_lock = threading.Lock()
+
+
+# Per-user data directory, following each platform's convention
+def data_dir():
+    if os.environ.get('DAIJIRIN_SCRAPER_HOME'):
+        return os.environ['DAIJIRIN_SCRAPER_HOME']
+    if sys.platform == 'win32':
+        base = os.environ.get('APPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Application Support')
+    else:
+        base = os.environ.get(
+            'XDG_DATA_HOME', os.path.expanduser('~/.local/share')
+        )
+    return os.path.join(base, 'daijirin-scraper')
+
+
+def cache_path():
+    return settings['path'] or os.path.join(data_dir(), 'cache.sqlite')
+
+
+# Changes any of the settings above; the database is reopened on the
+# next lookup in case the path changed
+def configure(**kwargs):
+    global _db
+
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError('unknown cache setting: {}'.format(key))
+        settings[key] = value
+
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+        _db = None
+
+
+# Full-width letters and digits, half-width kana and runs of spaces
+# are folded into one form, so every variant of a term shares a key
+def normalize_term(term):
+    return ' '.join(unicodedata.normalize('NFKC', term).split())
+
+
+def _connect():
+    global _db
+
+    if _db is None:
+        path = cache_path()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # One connection shared by every worker thread, guarded by _db_lock
+        db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL lets several CLI processes read while one of them writes
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                term TEXT NOT NULL,
+                url_id TEXT NOT NULL,
+                html BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (term, url_id)
+            )
+        ''')
+        db.execute(
+            'CREATE INDEX IF NOT EXISTS pages_lru ON pages (accessed_at)'
+        )
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                term TEXT NOT NULL,
+                url_id TEXT NOT NULL,
+                parser_version INTEGER NOT NULL,
+                candidates TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                PRIMARY KEY (term, url_id)
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS misses (
+                term TEXT NOT NULL,
+                url_id TEXT NOT NULL,
+                parser_version INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                PRIMARY KEY (term, url_id)
+            )
+        ''')
+        db.commit()
+        _db = db
+    return _db
+
+
+def get_page(term, url_id):
+    with _db_lock:
+        db = _connect()
+        row = db.execute(
+            'SELECT html, etag, last_modified, fetched_at FROM pages '
+            'WHERE term = ? AND url_id = ?',
+            (normalize_term(term), url_id)
+        ).fetchone()
+        if row is not None:
+            db.execute(
+                'UPDATE pages SET accessed_at = ? '
+                'WHERE term = ? AND url_id = ?',
+                (time.time(), normalize_term(term), url_id)
+            )
+            db.commit()
+    if row is None:
+        return None
+    return {
+        'html': row[0],
+        'etag': row[1],
+        'last_modified': row[2],
+        'fetched_at': row[3],
+    }
+
+
+def put_page(term, url_id, html, etag=None, last_modified=None):
+    now = time.time()
+    with _db_lock:
+        db = _connect()
+        db.execute(
+            'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (normalize_term(term), url_id, html, etag, last_modified,
+             len(html), now, now)
+        )
+        # The page changed, so whatever was parsed from it is outdated
+        db.execute(
+            'DELETE FROM entries WHERE term = ? AND url_id = ?',
+            (normalize_term(term), url_id)
+        )
+        db.execute(
+            'DELETE FROM misses WHERE term = ? AND url_id = ?',
+            (normalize_term(term), url_id)
+        )
+        _evict(db)
+        db.commit()
+
+
+# Returns the parsed candidates for a term, or None if there are none
+# that are fresh and were made by this parser_version. `page_id` is the
+# page the entry was parsed from when that isn't the dictionary's own,
+# such as the page that holds every dictionary.
+def get_entry(term, url_id, parser_version, page_id=None):
+    if not settings['enabled']:
+        return None
+
+    with _db_lock:
+        db = _connect()
+        row = db.execute(
+            'SELECT candidates FROM entries '
+            'WHERE term = ? AND url_id = ? AND parser_version = ? '
+            'AND stored_at >= ?',
+            (normalize_term(term), url_id, parser_version,
+             time.time() - settings['ttl'])
+        ).fetchone()
+        if row is not None:
+            # Pages are evicted by when they were last used, and a hit
+            # here uses the page without reading it
+            db.execute(
+                'UPDATE pages SET accessed_at = ? '
+                'WHERE term = ? AND url_id IN (?, ?)',
+                (time.time(), normalize_term(term), url_id,
+                 page_id or url_id)
+            )
+            db.commit()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def put_entry(term, url_id, parser_version, candidates):
+    if not settings['enabled']:
+        return
+
+    with _db_lock:
+        db = _connect()
+        db.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+            (normalize_term(term), url_id, parser_version,
+             json.dumps(candidates, ensure_ascii=False), time.time())
+        )
+        db.execute(
+            'DELETE FROM misses WHERE term = ? AND url_id = ?',
+            (normalize_term(term), url_id)
+        )
+        db.commit()
+
+
+# Whether this parser_version recently found no entry for the term
+def is_miss(term, url_id, parser_version):
+    if not settings['enabled']:
+        return False
+
+    with _db_lock:
+        row = _connect().execute(
+            'SELECT 1 FROM misses '
+            'WHERE term = ? AND url_id = ? AND parser_version = ? '
+            'AND stored_at >= ?',
+            (normalize_term(term), url_id, parser_version,
+             time.time() - settings['miss_ttl'])
+        ).fetchone()
+    return row is not None
+
+
+def put_miss(term, url_id, parser_version):
+    if not settings['enabled']:
+        return
+
+    with _db_lock:
+        db = _connect()
+        db.execute(
+            'INSERT OR REPLACE INTO misses VALUES (?, ?, ?, ?)',
+            (normalize_term(term), url_id, parser_version, time.time())
+        )
+        db.commit()
+
+
+# Forgets that `terms` (or every term) had no entry, so they are looked
+# up again. Returns how many were forgotten.
+def purge_misses(terms=None):
+    with _db_lock:
+        db = _connect()
+        if terms is None:
+            removed = db.execute('DELETE FROM misses').rowcount
+        else:
+            removed = sum(
+                db.execute('DELETE FROM misses WHERE term = ?',
+                           (normalize_term(t),)).rowcount
+                for t in terms
+            )
+        db.commit()
+    return removed
+
+
+# Marks a stale page as fresh again after weblio answered 304
+def revalidated(term, url_id):
+    with _db_lock:
+        db = _connect()
+        now = time.time()
+        db.execute(
+            'UPDATE pages SET fetched_at = ?, accessed_at = ? '
+            'WHERE term = ? AND url_id = ?',
+            (now, now, normalize_term(term), url_id)
+        )
+        db.commit()
+
+
+# Drops least recently used pages until the cache fits its size cap
+def _evict(db):
+    total = db.execute(
+        'SELECT COALESCE(SUM(size), 0) FROM pages'
+    ).fetchone()[0]
+    if total <= settings['max_bytes']:
+        return
+
+    doomed = []
+    for term, url_id, size in db.execute(
+            'SELECT term, url_id, size FROM pages ORDER BY accessed_at'):
+        if total <= settings['max_bytes']:
+            break
+        doomed.append((term, url_id))
+        total -= size
+    db.executemany(
+        'DELETE FROM pages WHERE term = ? AND url_id = ?', doomed
+    )
+    db.executemany(
+        'DELETE FROM entries WHERE term = ? AND url_id = ?', doomed
+    )
+
+
+# Returns the page source for a term, from the cache when possible.
+# A download stops once done(body so far) is true, and only what was
+# read by then is returned and cached. Raises requests.HTTPError if
+# weblio didn't answer with the page or its not-found page.
+def fetch_page(term, url_id, url, done=None):
+    if not settings['enabled']:
+        return session.read_until(
+            session.check(session.fetch(url, stream=True)), done
+        )
+
+    with metrics.timed('cache'):
+        cached = get_page(term, url_id)
+    if (cached is not None and
+            time.time() - cached['fetched_at'] < settings['ttl']):
+        metrics.count('page_hits')
+        return cached['html']
+    metrics.count('page_misses')
+
+    headers = {}
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    response = session.check(
+        session.fetch(url, headers=headers, stream=True)
+    )
+
+    if response.status_code == 304 and cached is not None:
+        session.close(response)
+        metrics.count('page_revalidated')
+        revalidated(term, url_id)
+        return cached['html']
+
+    html = session.read_until(response, done)
+    if response.status_code == 200:
+        put_page(
+            term, url_id, html,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified')
+        )
+    return html
+
+
+def stats():
+    with _db_lock:
+        db = _connect()
+        entries, size = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages'
+        ).fetchone()
+        stale = db.execute(
+            'SELECT COUNT(*) FROM pages WHERE fetched_at < ?',
+            (time.time() - settings['ttl'],)
+        ).fetchone()[0]
+        parsed = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        misses = db.execute(
+            'SELECT COUNT(*) FROM misses WHERE stored_at >= ?',
+            (time.time() - settings['miss_ttl'],)
+        ).fetchone()[0]
+    return {
+        'path': cache_path(),
+        'entries': entries,
+        'parsed': parsed,
+        'misses': misses,
+        'bytes': size,
+        'stale': stale,
+        'max_bytes': settings['max_bytes'],
+    }
+
+
+# Removes pages and misses past their TTLs and trims the cache to its
+# size cap. Parse results and misses from other parser versions are
+# dropped too.
+def prune(parser_version=None):
+    with _db_lock:
+        db = _connect()
+        expiry = time.time() - settings['ttl']
+        removed = db.execute(
+            'DELETE FROM pages WHERE fetched_at < ?', (expiry,)
+        ).rowcount
+        db.execute('DELETE FROM entries WHERE stored_at < ?', (expiry,))
+        db.execute(
+            'DELETE FROM misses WHERE stored_at < ?',
+            (time.time() - settings['miss_ttl'],)
+        )
+        if parser_version is not None:
+            db.execute(
+                'DELETE FROM entries WHERE parser_version != ?',
+                (parser_version,)
+            )
+            db.execute(
+                'DELETE FROM misses WHERE parser_version != ?',
+                (parser_version,)
+            )
+        _evict(db)
+        db.commit()
+        db.execute('VACUUM')
+    return removed
+
+
+def clear():
+    with _db_lock:
+        db = _connect()
+        removed = db.execute('DELETE FROM pages').rowcount
+        db.execute('DELETE FROM entries')
+        db.execute('DELETE FROM misses')
+        db.commit()
+        db.execute('VACUUM')
+    return removed
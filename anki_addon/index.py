@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+'''
+Local dictionary index for offline lookups.
+
+Every page that is parsed adds its entries here, keyed by the term that
+was looked up, the spellings in each heading's 【】 and each heading's
+yomigana. Keys are folded with NFKC (so full and half width forms
+match) and katakana is folded into hiragana, so ことば, コトバ and
+ｺﾄﾊﾞ all find 言葉. Unlike the page cache nothing here expires, so
+with `offline` set lookups are answered from the index alone.
+
+The index is a SQLite file next to the cache. export() and load()
+move it between machines as JSON lines.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+try:
+    from . import cache
+except ImportError:
+    import cache
+
+settings = {
+    'enabled': True,
+    # Answer lookups from the index only, without going online
+    'offline': False,
+    # Defaults to index.sqlite inside cache.data_dir()
+    'path': None,
+}
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def index_path():
+    return settings['path'] or os.path.join(cache.data_dir(), 'index.sqlite')
+
+
+# Changes any of the settings above; the database is reopened on the
+# next lookup in case the path changed
+def configure(**kwargs):
+    global _db
+
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError('unknown index setting: {}'.format(key))
+        settings[key] = value
+
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+        _db = None
+
+
+def to_hiragana(text):
+    return ''.join(
+        chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text
+    )
+
+
+# The form every key is stored and looked up in
+def fold(text):
+    return to_hiragana(
+        ''.join(unicodedata.normalize('NFKC', text).split())
+    )
+
+
+# Spellings are listed like 【掛ける・懸ける・架ける】
+def spellings(heading):
+    inside = heading.partition('【')[2].partition('】')[0]
+    return [s for s in inside.split('・') if s]
+
+
+def keys(term, candidates):
+    found = {fold(term)}
+    for c in candidates:
+        found.update(fold(s) for s in spellings(c['heading']))
+        if c.get('yomigana'):
+            found.add(fold(c['yomigana']))
+    found.discard('')
+    return found
+
+
+def _connect():
+    global _db
+
+    if _db is None:
+        path = index_path()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS headwords (
+                term TEXT NOT NULL,
+                url_id TEXT NOT NULL,
+                parser_version INTEGER NOT NULL,
+                candidates TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                PRIMARY KEY (term, url_id)
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS keys (
+                key TEXT NOT NULL,
+                url_id TEXT NOT NULL,
+                term TEXT NOT NULL,
+                PRIMARY KEY (key, url_id, term)
+            ) WITHOUT ROWID
+        ''')
+        db.commit()
+        _db = db
+    return _db
+
+
+def _add(db, term, url_id, parser_version, candidates, stored_at):
+    db.execute(
+        'INSERT OR REPLACE INTO headwords VALUES (?, ?, ?, ?, ?)',
+        (term, url_id, parser_version,
+         json.dumps(candidates, ensure_ascii=False), stored_at)
+    )
+    db.execute(
+        'DELETE FROM keys WHERE url_id = ? AND term = ?', (url_id, term)
+    )
+    db.executemany(
+        'INSERT OR IGNORE INTO keys VALUES (?, ?, ?)',
+        [(k, url_id, term) for k in keys(term, candidates)]
+    )
+
+
+# Records the parsed candidates of a term's page
+def add(term, url_id, parser_version, candidates):
+    if not settings['enabled']:
+        return
+
+    with _db_lock:
+        db = _connect()
+        _add(db, cache.normalize_term(term), url_id, parser_version,
+             candidates, time.time())
+        db.commit()
+
+
+# Returns the candidates of every term whose spelling or reading folds
+# to the same key as `text`, or None if there are none
+def find(text, url_id):
+    with _db_lock:
+        rows = _connect().execute(
+            'SELECT h.candidates FROM keys k JOIN headwords h '
+            'ON h.term = k.term AND h.url_id = k.url_id '
+            'WHERE k.key = ? AND k.url_id = ? ORDER BY h.term',
+            (fold(text), url_id)
+        ).fetchall()
+
+    candidates = []
+    for row in rows:
+        for c in json.loads(row[0]):
+            # The same heading can be on the pages of several spellings
+            if c not in candidates:
+                candidates.append(c)
+    return candidates or None
+
+
+# Adds every parsed page already in the cache. Returns how many.
+def build():
+    with cache._db_lock:
+        rows = cache._connect().execute(
+            'SELECT term, url_id, parser_version, candidates, stored_at '
+            'FROM entries'
+        ).fetchall()
+
+    with _db_lock:
+        db = _connect()
+        for term, url_id, parser_version, candidates, stored_at in rows:
+            _add(db, term, url_id, parser_version, json.loads(candidates),
+                 stored_at)
+        db.commit()
+    return len(rows)
+
+
+def stats():
+    with _db_lock:
+        db = _connect()
+        terms = db.execute('SELECT COUNT(*) FROM headwords').fetchone()[0]
+        count = db.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+    return {'path': index_path(), 'terms': terms, 'keys': count}
+
+
+# Writes the index to `path` as one JSON object per term
+def export(path):
+    with _db_lock:
+        rows = _connect().execute(
+            'SELECT term, url_id, parser_version, candidates, stored_at '
+            'FROM headwords ORDER BY url_id, term'
+        ).fetchall()
+
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        for term, url_id, parser_version, candidates, stored_at in rows:
+            f.write(json.dumps({
+                'term': term,
+                'url_id': url_id,
+                'parser_version': parser_version,
+                'candidates': json.loads(candidates),
+                'stored_at': stored_at,
+            }, ensure_ascii=False) + '\n')
+    os.replace(path + '.tmp', path)
+    return len(rows)
+
+
+# Merges an exported index into this one. A term already here is only
+# replaced by a newer copy. Returns how many terms were taken.
+def load(path):
+    taken = 0
+    with open(path, encoding='utf-8') as f, _db_lock:
+        db = _connect()
+        for line in f:
+            if not line.strip():
+                continue
+            r = json.loads(line)
+            row = db.execute(
+                'SELECT stored_at FROM headwords '
+                'WHERE term = ? AND url_id = ?', (r['term'], r['url_id'])
+            ).fetchone()
+            if row is not None and row[0] >= r['stored_at']:
+                continue
+            _add(db, r['term'], r['url_id'], r['parser_version'],
+                 r['candidates'], r['stored_at'])
+            taken += 1
+        db.commit()
+    return taken
+
+
+def clear():
+    with _db_lock:
+        db = _connect()
+        removed = db.execute('DELETE FROM headwords').rowcount
+        db.execute('DELETE FROM keys')
+        db.commit()
+        db.execute('VACUUM')
+    return removed
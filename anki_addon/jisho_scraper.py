@@ -21,12 +21,16 @@ from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 
-from bs4 import BeautifulSoup
-import requests
 import os
 import sys
-import re
+import threading
+from collections import deque
 from .jisho_config import jisho_config
+from .scraper import (
+    iter_lookups, CANCELLED, ERROR, NOT_FOUND, NOT_FOUND_CACHED
+)
+from . import cache
+from . import index
 
 
 # Helper function to get icon path
@@ -43,107 +47,76 @@ def iconPath():
     return icon_path
 
 
-class Scraper:
-    def __init__(self, term, jisho='daijirin'):
-        self.term = term
-        self.jisho = jisho
-        self.jisho_name = jisho_config[self.jisho]['name']
-        self.url_id = jisho_config[self.jisho]['url_id']
-        self.data = self.scrape()
-
-    def scrape(self):
-        # Fetch initial page source
-        url = 'https://www.weblio.jp/content/{0}?dictCode={1}'.format(
-            self.term, self.url_id.upper() )
-        sauce = requests.get(url).content
-        soup = BeautifulSoup(sauce, "html.parser")
-
-        # Find the header of selected dictionary
-        header_url = soup.find('a', href=re.compile(
-            ".+/cat/dictionary/{}.*".format(self.url_id))
-        )
-
-        try:
-            header = header_url.find_parent('div', class_='pbarT')
-        except:
-            header = None
-            pass
-
-        if header is None:
-            return None
-
-        # Find the header of selected dictionary
-        entry = header.find_next_sibling('div', class_='kijiWrp')
-
-        # Outputs Daijirin header(s) to a list for the user to choose from
-        def parse_daijirin_def():
-            data = {}
-
-            entry_heads = entry.find_all('div', class_='NetDicHead')
-
-            if len(entry_heads) > 1:
-                chosen_head = EntrySelectDialog(entry_heads).selection
-                if chosen_head == 'cancelled':
-                    return 'cancelled'
-            elif len(entry_heads) == 1:
-                chosen_head = 0
-            else:
-                return None
-
-            chosen_body = entry_heads[chosen_head].find_next_sibling(
-                'div', class_='NetDicBody')
+# Keep the cache and the offline index with the add-on's user files so
+# they survive updates
+cache.configure(path=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'user_files', 'cache.sqlite'
+))
+index.configure(path=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'user_files', 'index.sqlite'
+))
 
-            data['yomigana'] = entry_heads[chosen_head].find('b').text
+# Cache limits from the add-on's config (Tools > Add-ons > Config)
+config = mw.addonManager.getConfig(__name__) or {}
+cache.configure(**{
+    key: int(config[name] * scale)
+    for name, key, scale in (('cache_ttl_days', 'ttl', 24 * 60 * 60),
+                             ('miss_ttl_days', 'miss_ttl', 24 * 60 * 60),
+                             ('cache_max_mb', 'max_bytes', 1024 * 1024))
+    if config.get(name) is not None
+})
 
-            # Omits repetitive yomigana if term is strictly in hiragana
-            if data['yomigana'] == self.term:
-                data['yomigana'] = ''
-
-            defs = chosen_body.find_all('span', style="text-indent:0;")
-            # If multiple definitions
-            if len(defs) > 1:
-                defs = [d.text for d in defs]
-                # Removes extra whitespaces in the definition strings
-                stripped = ["".join(piece.split()) for piece in defs]
-
-                data['body'] = "\n".join(
-                    ['<ol>'] +
-                    [('<li>' + d + '</li>') for d in stripped] +
-                    ['</ol>']
-                )
-            # If only one definition
-            else:
-                single_def = chosen_body.select_one("div div div").text
-                data['body'] = '<br>\n' + "".join(single_def.split())
 
-            return data
+# Lets the user pick an entry when a page has more than one heading
+def choose_entry(headings):
+    selection = EntrySelectDialog(headings).selection
+    if selection == 'cancelled':
+        return None
+    return selection
 
-        def parse_wiki_def():
-            data = {}
 
-            chosen_head = entry.find('h2', class_='midashigo')
-            chosen_body = chosen_head\
-                .find_next_sibling('div', class_="Wkpja")\
-                .find('p', class_=None)\
-                .text
+# Number of terms looked up at the same time in a multi-word search
+SEARCH_JOBS = 4
 
-            data['yomigana'] = ''
-            data['body'] = '<br>\n' + chosen_body
 
-            return data
+class SearchWorker(QThread):
+    # Both are emitted off the UI thread; Qt queues them onto it
+    result = pyqtSignal(object)
+    prompt = pyqtSignal(object, object)
 
-        def parse_action(dictionary):
-            return {
-                'daijirin': parse_daijirin_def,
-                'wikipedia': parse_wiki_def
-            }[dictionary]()
-
-        definition = parse_action(self.jisho)
+    def __init__(self, words, jisho, parent):
+        super().__init__(parent)
+        self.words = words
+        self.jisho = jisho
+        self.cancelled = False
 
-        html = '【{0}】 {1}{2}'.format(
-            self.term, definition['yomigana'], definition['body']
+    def run(self):
+        # Results come back in the order the terms were typed
+        lookups = iter_lookups(
+            self.words, self.jisho, concurrency=SEARCH_JOBS,
+            choose=self.choose, ordered=True
         )
-        return html
+        try:
+            for result in lookups:
+                if self.cancelled:
+                    break
+                self.result.emit(result)
+        finally:
+            lookups.close()
+
+    # Runs on a lookup thread. The choice is made on the UI thread and
+    # only this lookup waits for it; the others carry on.
+    def choose(self, headings):
+        if self.cancelled:
+            return None
+        reply = {'choice': None, 'answered': threading.Event()}
+        self.prompt.emit(headings, reply)
+        # Checks back now and then in case the search is cancelled
+        # before the UI thread gets to the prompt
+        while not reply['answered'].wait(0.1):
+            if self.cancelled:
+                return None
+        return reply['choice']
 
 
 class ScraperWindow(QDialog):
@@ -178,6 +151,15 @@ class ScraperWindow(QDialog):
             self.set_jisho)
         hl.addWidget(self.jisho_select)
 
+        self.offline_box = QCheckBox('Offline')
+        self.offline_box.setFont(default_font)
+        self.offline_box.setToolTip(
+            'Only search definitions already saved on this computer')
+        self.offline_box.setChecked(index.settings['offline'])
+        self.offline_box.toggled.connect(
+            lambda checked: index.configure(offline=checked))
+        hl.addWidget(self.offline_box)
+
         self.search_btn = QPushButton(u' 検索 (\u23CE) ')
         self.search_btn.setFont(default_font)
         self.search_btn.setToolTip('Search for input term(s)')
@@ -197,10 +179,33 @@ class ScraperWindow(QDialog):
         self.output_box = QPlainTextEdit()
         self.output_box.setFont(output_font)
 
+        self.progress = QProgressBar()
+        self.progress.setFont(default_font)
+        self.progress.hide()
+
+        self.cancel_btn = QPushButton(u' 中止 ')
+        self.cancel_btn.setFont(default_font)
+        self.cancel_btn.setToolTip('Stop the current search')
+        self.cancel_btn.clicked.connect(self.onCancel)
+        self.cancel_btn.hide()
+
+        pl = QHBoxLayout()
+        pl.addWidget(self.progress)
+        pl.addWidget(self.cancel_btn)
+
         vl.addLayout(hl)
+        vl.addLayout(pl)
         vl.addWidget(self.output_box)
         self.setLayout(vl)
 
+        self.worker = None
+        # Set when the window is closed during a search; it closes once
+        # the search has stopped
+        self.closing = False
+        # Entry choices wait here so only one dialog is open at a time
+        self.prompts = deque()
+        self.prompting = False
+
         self.call_jisho = self.set_jisho()
         self.search_box.setFocus()
         self.show()
@@ -235,26 +240,81 @@ class ScraperWindow(QDialog):
     def onSearch(self):
         query = self.search_box.text()
 
-        if query == '':
+        if query == '' or self.worker is not None:
             return
         else:
             words = query.split()
 
         self.setWindowTitle('Searching...')
+        self.search_btn.setEnabled(False)
+        self.progress.setRange(0, len(words))
+        self.progress.setValue(0)
+        self.progress.show()
+        self.cancel_btn.show()
+
+        # Lookups run off the UI thread and stream back as they finish
+        self.worker = SearchWorker(words, self.jisho, self)
+        self.worker.result.connect(self.onResult)
+        self.worker.prompt.connect(self.onPrompt)
+        self.worker.finished.connect(self.onSearchDone)
+        self.worker.start()
+
+    def onResult(self, result):
+        if self.closing:
+            return
+        self.progress.setValue(self.progress.value() + 1)
+        self.setWindowTitle('Searching... ({0}/{1})'.format(
+            self.progress.value(), self.progress.maximum()))
 
-        results = [Scraper(term, self.jisho).data for term in words]
-
-        for i, result in enumerate(results):
-            if result == 'cancelled':
-                pass
-            elif result is None:
-                NoneFound(words[i], self.jisho)
+        if result.status == CANCELLED:
+            pass
+        elif result.status == NOT_FOUND:
+            NoneFound(result.term, result.jisho)
+        elif result.status == NOT_FOUND_CACHED:
+            NoneFound(result.term, result.jisho, known=True)
+        elif result.status == ERROR:
+            tooltip("Could not look up {0}: {1}".format(
+                result.term, result.error))
+        else:
+            if self.output_box.toPlainText() == '':
+                self.output_box.appendPlainText(result.html)
             else:
-                if self.output_box.toPlainText() == '':
-                    self.output_box.appendPlainText(result)
-                else:
-                    div_str = '\n<div>\n' + result + '\n</div>'
-                    self.output_box.appendPlainText(div_str)
+                div_str = '\n<div>\n' + result.html + '\n</div>'
+                self.output_box.appendPlainText(div_str)
+
+    def onPrompt(self, headings, reply):
+        self.prompts.append((headings, reply))
+        # A dialog is already open; its loop below will get to this one
+        if self.prompting:
+            return
+
+        self.prompting = True
+        while self.prompts:
+            headings, reply = self.prompts.popleft()
+            if self.worker is not None and not self.worker.cancelled:
+                reply['choice'] = choose_entry(headings)
+            reply['answered'].set()
+        self.prompting = False
+
+    def onCancel(self):
+        if self.worker is None:
+            return
+
+        self.worker.cancelled = True
+        self.setWindowTitle('Cancelling...')
+        # Let lookups waiting on a choice give up
+        while self.prompts:
+            headings, reply = self.prompts.popleft()
+            reply['answered'].set()
+
+    def onSearchDone(self):
+        self.worker = None
+        if self.closing:
+            self.close()
+            return
+        self.progress.hide()
+        self.cancel_btn.hide()
+        self.search_btn.setEnabled(True)
 
         self.search_box.setText('')
         self.search_box.setFocus()
@@ -263,6 +323,18 @@ class ScraperWindow(QDialog):
             '(can do multi-word search separated by spaces)'
         )
 
+    # Stops a running search before the window goes away. Waiting for
+    # it here would hold up Anki, so the window hides and closes from
+    # onSearchDone instead.
+    def closeEvent(self, event):
+        if self.worker is not None:
+            self.onCancel()
+            self.closing = True
+            self.hide()
+            event.ignore()
+            return
+        super().closeEvent(event)
+
     def keyPressEvent(self, event):
         mods = QApplication.keyboardModifiers()
 
@@ -311,8 +383,7 @@ class EntrySelectDialog(QDialog):
         self.listing = QListWidget()
         self.listing.setFont(font)
         for choice in choice_list:
-            c = choice.text
-            self.listing.addItem(c)
+            self.listing.addItem(choice)
 
         QBtn = QDialogButtonBox.Ok | QDialogButtonBox.Cancel
         self.buttonBox = QDialogButtonBox(QBtn)
@@ -349,8 +420,10 @@ class EntrySelectDialog(QDialog):
         self.onReject()
 
 
+# `known` misses were answered from the cache; they can be forgotten
+# so the next search asks weblio again
 class NoneFound(QMessageBox):
-    def __init__(self, search, jisho):
+    def __init__(self, search, jisho, known=False):
         super().__init__()
 
         self.setWindowIcon(QIcon(iconPath()))
@@ -361,15 +434,23 @@ class NoneFound(QMessageBox):
 
         self.setIcon(QMessageBox.Information)
         self.setText("No " + jisho_config[jisho]['name'] +
-                     " definitions found for " + search)
+                     " definitions found for " + search +
+                     (" when it was last searched" if known else ""))
         self.setInformativeText(
             "<a href=\"" + search_url + "\">Check weblio results " +
             "for other dictionary definitions.</a>"
         )
         self.setWindowTitle("None found")
+        if known:
+            forget = self.addButton("Search weblio next time",
+                                    QMessageBox.ActionRole)
+            self.addButton(QMessageBox.Ok)
 
         self.exec_()
 
+        if known and self.clickedButton() is forget:
+            cache.purge_misses([search])
+
 
 def addMyButton(buttons, editor):
     editor._links['大辞林'] = ScraperWindow
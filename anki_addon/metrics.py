@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Timings of each phase of a lookup, and counters of what happened.
+
+Code wraps a phase in `with metrics.timed('parse'):` and notes events
+with `metrics.count('retries')`. Nothing is recorded until
+configure(enabled=True); until then timed() hands back a shared
+do-nothing context manager and count() returns straight away.
+
+summary() gives p50/p95/p99 per phase, which report(), to_json() and
+to_prometheus() present for people, scripts and monitoring. Counts and
+totals are exact, but the percentiles come from a random sample of at
+most MAX_SAMPLES timings per phase, so a long-running server doesn't
+keep every timing it ever took.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import json
+import random
+import threading
+import time
+from collections import Counter
+
+settings = {
+    'enabled': False,
+}
+
+# What each phase covers, in the order they happen
+PHASES = {
+    'cache': 'reading parsed entries and pages from the cache',
+    'page_wait': 'waiting for a page slot in memory-bounded mode',
+    'rate_wait': 'waiting for the rate limiter',
+    'request': 'connecting and waiting for the response headers',
+    'backoff': 'sleeping before a retry',
+    'download': 'reading the response body',
+    'soup': 'building the BeautifulSoup tree',
+    'walk': 'finding the sections and reading the definitions',
+    'store': 'saving parsed entries to the cache and index',
+    'write': 'writing results to the output file',
+}
+
+# Timings kept per phase for the percentiles
+MAX_SAMPLES = 10000
+
+_samples = {}
+_seen = Counter()
+_totals = Counter()
+_counters = Counter()
+_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError('unknown metrics setting: {}'.format(key))
+        settings[key] = value
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+        _seen.clear()
+        _totals.clear()
+        _counters.clear()
+
+
+class _Timer:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_timer = _NoTimer()
+
+
+def timed(name):
+    if not settings['enabled']:
+        return _no_timer
+    return _Timer(name)
+
+
+def record(name, seconds):
+    if not settings['enabled']:
+        return
+    with _lock:
+        _seen[name] += 1
+        _totals[name] += seconds
+        samples = _samples.setdefault(name, [])
+        if len(samples) < MAX_SAMPLES:
+            samples.append(seconds)
+        else:
+            # Reservoir sampling: every timing so far is equally likely
+            # to be among those kept
+            i = random.randrange(_seen[name])
+            if i < MAX_SAMPLES:
+                samples[i] = seconds
+
+
+def count(name, n=1):
+    if not settings['enabled']:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+def percentile(samples, p):
+    return samples[max(0, int(len(samples) * p + 0.5) - 1)]
+
+
+def summary():
+    with _lock:
+        samples = {k: sorted(v) for k, v in _samples.items()}
+        seen = dict(_seen)
+        totals = dict(_totals)
+        counters = dict(_counters)
+
+    order = list(PHASES) + sorted(set(samples) - set(PHASES))
+    phases = {}
+    for name in order:
+        s = samples.get(name)
+        if not s:
+            continue
+        phases[name] = {
+            'count': seen[name],
+            'total_s': totals[name],
+            'p50_ms': 1000 * percentile(s, 0.50),
+            'p95_ms': 1000 * percentile(s, 0.95),
+            'p99_ms': 1000 * percentile(s, 0.99),
+        }
+    return {'phases': phases, 'counters': counters}
+
+
+# A table for the console
+def report():
+    info = summary()
+    lines = ['{0:<11} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'phase', 'count', 'total s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for name, p in info['phases'].items():
+        lines.append(
+            '{0:<11} {1:>7} {2:>10.3f} {3:>10.2f} {4:>10.2f} '
+            '{5:>10.2f}'.format(name, p['count'], p['total_s'],
+                                p['p50_ms'], p['p95_ms'], p['p99_ms']))
+    if info['counters']:
+        lines.append('')
+        lines.extend('{0:<24} {1}'.format(k, v)
+                     for k, v in sorted(info['counters'].items()))
+    return '\n'.join(lines)
+
+
+def to_json():
+    return json.dumps(summary(), indent=2)
+
+
+# The Prometheus text format, e.g. for node_exporter's textfile
+# collector
+def to_prometheus():
+    info = summary()
+    lines = [
+        '# HELP daijirin_phase_seconds Time spent in each lookup phase.',
+        '# TYPE daijirin_phase_seconds summary',
+    ]
+    for name, p in info['phases'].items():
+        for q, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'),
+                       ('0.99', 'p99_ms')):
+            lines.append(
+                'daijirin_phase_seconds{{phase="{0}",quantile="{1}"}} '
+                '{2:.6f}'.format(name, q, p[key] / 1000))
+        lines.append('daijirin_phase_seconds_sum{{phase="{0}"}} {1:.6f}'
+                     .format(name, p['total_s']))
+        lines.append('daijirin_phase_seconds_count{{phase="{0}"}} {1}'
+                     .format(name, p['count']))
+    for name, value in sorted(info['counters'].items()):
+        lines.append('# TYPE daijirin_{0}_total counter'.format(name))
+        lines.append('daijirin_{0}_total {1}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+# Writes the summary to `path`: JSON if it ends in .json, otherwise
+# Prometheus text
+def dump(path):
+    text = to_json() if path.endswith('.json') else to_prometheus()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Addon: Daijirin Definition Scraper
+Copyright: (c) Jesse Barkdoll 2017-2019 <https://github.com/barkdoll>
+
+Tools menu action that looks up the terms on a deck's next new cards
+in the background, so searching for them later comes from the cache.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+from aqt import mw
+from aqt.utils import showInfo, tooltip
+from anki.utils import stripHTML, ids2str
+from aqt.qt import *
+
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+
+from .jisho_config import jisho_config
+from .jisho_scraper import iconPath, ScraperWindow
+from .scraper import prefetch, FOUND
+
+# Kept low so prefetching never takes much of the request budget;
+# searches from the editor go ahead of it at the rate limiter anyway
+PREFETCH_JOBS = 2
+
+# The running prefetch, if any. It outlives the dialog that started it.
+worker = None
+
+
+class PrefetchWorker(QThread):
+    def __init__(self, terms, jisho, parent):
+        super().__init__(parent)
+        self.terms = terms
+        self.jisho = jisho
+        self.cancelled = False
+        self.found = 0
+
+    def run(self):
+        lookups = prefetch(self.terms, self.jisho, concurrency=PREFETCH_JOBS)
+        try:
+            for result in lookups:
+                if result.status == FOUND:
+                    self.found += 1
+                if self.cancelled:
+                    break
+        finally:
+            lookups.close()
+
+
+# The terms in `field` of the next `count` new cards in the deck, in
+# the order they will be shown
+def next_new_terms(did, field, count):
+    cids = mw.col.findCards('deck:"{}" is:new'.format(
+        mw.col.decks.name(did).replace('"', '\\"')))
+    cids = mw.col.db.list(
+        'select id from cards where id in {} order by due, ord '
+        'limit ?'.format(ids2str(cids)), count)
+
+    terms = []
+    for cid in cids:
+        note = mw.col.getCard(cid).note()
+        if field in note:
+            term = stripHTML(note[field]).strip()
+            if term and term not in terms:
+                terms.append(term)
+    return terms
+
+
+class PrefetchDialog(QDialog):
+    def __init__(self, parent):
+        super().__init__(parent)
+
+        self.setWindowIcon(QIcon(iconPath()))
+        self.setWindowTitle('Prefetch 辞書 definitions')
+
+        font = ScraperWindow.setupFont(self)
+        self.setFont(font)
+
+        self.decks = sorted(mw.col.decks.allNames())
+        self.deck_select = QComboBox()
+        self.deck_select.addItems(self.decks)
+        current = mw.col.decks.current()['name']
+        if current in self.decks:
+            self.deck_select.setCurrentIndex(self.decks.index(current))
+
+        self.field = QLineEdit('Front')
+
+        self.count = QSpinBox()
+        self.count.setRange(1, 1000)
+        self.count.setValue(50)
+
+        self.jisho_select = QComboBox()
+        self.jisho_select.addItems(
+            [value['name'] for key, value in jisho_config.items()]
+        )
+
+        form = QFormLayout()
+        form.addRow('Deck', self.deck_select)
+        form.addRow('Term field', self.field)
+        form.addRow('New cards', self.count)
+        form.addRow('Dictionary', self.jisho_select)
+
+        self.status = QLabel()
+        self.start_btn = QPushButton(u' 開始 ')
+        self.start_btn.clicked.connect(self.onStart)
+        self.cancel_btn = QPushButton(u' 中止 ')
+        self.cancel_btn.clicked.connect(self.onCancel)
+
+        hl = QHBoxLayout()
+        hl.addWidget(self.status)
+        hl.addWidget(self.start_btn)
+        hl.addWidget(self.cancel_btn)
+
+        vl = QVBoxLayout()
+        vl.addLayout(form)
+        vl.addLayout(hl)
+        self.setLayout(vl)
+
+        if worker is not None:
+            self.status.setText('Prefetching...')
+            self.start_btn.setEnabled(False)
+
+        self.show()
+
+    def onStart(self):
+        global worker
+
+        did = mw.col.decks.id(self.deck_select.currentText())
+        terms = next_new_terms(
+            did, self.field.text().strip(), self.count.value()
+        )
+        if not terms:
+            showInfo('There are no new cards with that field to prefetch.')
+            return
+
+        jisho = list(jisho_config)[self.jisho_select.currentIndex()]
+        # Parented to the main window so it keeps going once this
+        # dialog is closed
+        worker = PrefetchWorker(terms, jisho, mw)
+        worker.finished.connect(onPrefetchDone)
+        worker.start(QThread.LowPriority)
+
+        tooltip('Prefetching {} terms in the background.'.format(len(terms)))
+        self.close()
+
+    def onCancel(self):
+        if worker is not None:
+            worker.cancelled = True
+        self.close()
+
+
+def onPrefetchDone():
+    global worker
+    done, worker = worker, None
+    tooltip('Prefetched {0} of {1} terms.'.format(
+        done.found, len(done.terms)))
+
+
+def setupMenu():
+    action = QAction('Prefetch 辞書 definitions...', mw)
+    action.triggered.connect(lambda: PrefetchDialog(mw))
+    mw.form.menuTools.addAction(action)
+
+
+setupMenu()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''
+Adaptive per-host request limiter.
+
+Every request to a host first takes a token from that host's bucket
+and one of its in-flight slots. The bucket refills at the host's
+current rate, which is halved when the host answers 429 or 5xx, drops
+the connection or slows down noticeably, and crawls back up towards
+the configured rate while responses stay healthy.
+
+Requests made inside `with background():` (prefetching, say) only go
+out when no other request to the host is waiting, and leave a token
+and an in-flight slot free, so lookups someone is waiting on go
+first.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import contextlib
+import threading
+import time
+
+settings = {
+    # Requests started per second, and how many may be saved up
+    'rate': 2.0,
+    'burst': 4,
+    # Requests to the same host waiting on a response at once
+    'max_in_flight': 4,
+    # The rate never drops below this however badly the host is doing
+    'min_rate': 0.2,
+    # Rate regained per healthy response
+    'recover_step': 0.05,
+    # Back off once responses take this many times the usual latency
+    'latency_factor': 3.0,
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Whether the current thread's requests are background ones
+_local = threading.local()
+
+
+# Changes any of the settings above; limiters made after this use them
+def configure(**kwargs):
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError('unknown rate limit setting: {}'.format(key))
+        if key in ('rate', 'min_rate') and value is not None and value <= 0:
+            raise ValueError('{} must be more than 0'.format(key))
+        if value is not None:
+            settings[key] = value
+
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def for_host(host):
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(**settings)
+        return _limiters[host]
+
+
+@contextlib.contextmanager
+def background(enabled=True):
+    previous = getattr(_local, 'background', False)
+    _local.background = enabled
+    try:
+        yield
+    finally:
+        _local.background = previous
+
+
+class HostLimiter:
+    def __init__(self, rate, burst, max_in_flight, min_rate, recover_step,
+                 latency_factor):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.min_rate = min_rate
+        self.recover_step = recover_step
+        self.latency_factor = latency_factor
+
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        # Foreground requests waiting in acquire()
+        self.waiting = 0
+        # Smoothed latency, and the best it has been
+        self.latency = None
+        self.baseline = None
+        self.backed_off_at = 0.0
+
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.refilled_at) * self.rate
+        )
+        self.refilled_at = now
+
+    # Blocks until a request may be sent
+    def acquire(self):
+        background = getattr(_local, 'background', False)
+        # Background requests leave room for one foreground request
+        spare = 1 if background else 0
+
+        with self.cond:
+            if not background:
+                self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    tokens = min(1 + spare, self.burst)
+
+                    if now < self.paused_until:
+                        wait = self.paused_until - now
+                    elif background and self.waiting:
+                        wait = None
+                    elif self.in_flight >= max(1, self.max_in_flight - spare):
+                        wait = None
+                    elif self.tokens >= tokens:
+                        self.tokens -= 1
+                        self.in_flight += 1
+                        return
+                    else:
+                        wait = (tokens - self.tokens) / self.rate
+
+                    self.cond.wait(wait)
+            finally:
+                if not background:
+                    self.waiting -= 1
+                    # Background requests may go again
+                    self.cond.notify_all()
+
+    # Called once the response (or error) is in. status is None when
+    # the request failed without one.
+    def release(self, status, latency, retry_after=None):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+
+            if status is None or status == 429 or status >= 500:
+                self._back_off(now)
+                if retry_after:
+                    self.paused_until = max(
+                        self.paused_until, now + retry_after
+                    )
+            else:
+                self._track_latency(now, latency)
+
+            self.cond.notify_all()
+
+    def _back_off(self, now):
+        # One slowdown per round trip, so a burst of bad responses to
+        # requests that were already in flight doesn't floor the rate
+        if now - self.backed_off_at < (self.latency or 1.0):
+            return
+        # A configured rate below min_rate is the floor, so backing
+        # off never raises the rate
+        self.rate = max(min(self.min_rate, self.max_rate), self.rate / 2)
+        self.backed_off_at = now
+
+    def _track_latency(self, now, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+
+        # The baseline follows improvements right away and drifts up
+        # slowly, so a lasting change in the host's speed is accepted
+        if self.baseline is None:
+            self.baseline = self.latency
+        else:
+            self.baseline = min(self.latency, self.baseline * 1.01)
+
+        if self.latency > self.baseline * self.latency_factor:
+            self._back_off(now)
+        else:
+            self.rate = min(self.max_rate, self.rate + self.recover_step)
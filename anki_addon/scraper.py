@@ -0,0 +1,723 @@
+# -*- coding: utf-8 -*-
+'''
+Addon: Daijirin Definition Scraper
+Copyright: (c) Jesse Barkdoll 2017-2019 <https://github.com/barkdoll>
+
+Fetching and parsing shared by the command line script and the Anki
+add-on. Front ends only supply how an entry is chosen when a page has
+more than one heading.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+from collections import deque, namedtuple
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+)
+import contextlib
+import functools
+import re
+import threading
+import time
+from urllib.parse import quote
+
+try:
+    from .jisho_config import jisho_config
+    from . import cache
+    from . import session
+    from . import ratelimit
+    from . import index
+    from . import metrics
+    from .index import to_hiragana
+except ImportError:
+    from jisho_config import jisho_config
+    import cache
+    import session
+    import ratelimit
+    import index
+    import metrics
+    from index import to_hiragana
+
+# Bump this whenever a change to the parsing below changes its output,
+# so cached parse results are re-derived from the cached pages
+PARSER_VERSION = 1
+
+# Returned as the scraper's data when the user backs out of choosing
+CANCELLED = 'cancelled'
+# Returned as the scraper's data when the choice is put off until later
+DEFERRED = 'deferred'
+
+# Lookup statuses
+FOUND = 'found'
+NOT_FOUND = 'not_found'
+ERROR = 'error'
+# Not found, going by a recent miss in the cache rather than the page.
+# Also returned as the scraper's data.
+NOT_FOUND_CACHED = 'not_found_cached'
+
+# Ways of picking between headings without asking anyone:
+# the first one, all of them, the one whose reading or spelling
+# matches the term, or none yet (the lookup comes back DEFERRED)
+PICK_FIRST = 'first'
+PICK_ALL = 'all'
+PICK_MATCH_READING = 'match-reading'
+PICK_LATER = 'later'
+PICK_POLICIES = (PICK_FIRST, PICK_ALL, PICK_MATCH_READING, PICK_LATER)
+
+# Cache key of the page that holds every dictionary's section, fetched
+# without a dictCode
+ALL_DICTIONARIES = '*'
+
+# One finished lookup. definition is the chosen candidate (heading,
+# yomigana, definitions and html), or the first of several in entries,
+# and timings holds seconds spent fetching, parsing and in total.
+Lookup = namedtuple(
+    'Lookup', 'term jisho status definition html error timings entries'
+)
+
+# BeautifulSoup tree builders, fastest first. html5lib is left out as it
+# is slower still and can't be limited to part of the page.
+BACKENDS = ('lxml', 'html.parser')
+
+settings = {
+    # One of BACKENDS, or None to use the fastest one installed
+    'backend': None,
+    # Only build the tree for the dictionary headers and sections
+    'region_only': True,
+    # Stop downloading a page once the wanted sections are in. This
+    # drops the connection, so the next request opens a new one.
+    'stop_early': True,
+    # Memory-bounded mode: at most this many pages are downloaded and
+    # parsed at once, however many lookups run, and each tree is torn
+    # down as soon as it has been read. None for no limit.
+    'max_pages': None,
+}
+
+_page_slots = None
+
+
+# Dictionary headers and the sections that follow them are all the
+# extraction plans below ever look at; the rest of the page is skipped
+@functools.lru_cache()
+def region():
+    from bs4 import SoupStrainer
+    classes = set()
+    for rules in jisho_config.values():
+        classes.update((rules['header_class'], rules['section_class']))
+    return SoupStrainer('div', class_=sorted(classes))
+
+
+@functools.lru_cache()
+def available_backend():
+    if settings['backend'] is not None:
+        return settings['backend']
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
+def configure(**kwargs):
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError('unknown parser setting: {}'.format(key))
+        if key == 'backend' and value not in BACKENDS + (None,):
+            raise ValueError('unknown parser backend: {}'.format(value))
+        if key == 'max_pages' and value is not None and value < 1:
+            raise ValueError('max_pages must be at least 1')
+        settings[key] = value
+    available_backend.cache_clear()
+
+    global _page_slots
+    if 'max_pages' in kwargs:
+        _page_slots = (threading.BoundedSemaphore(settings['max_pages'])
+                       if settings['max_pages'] else None)
+
+
+# Held from when a page starts downloading until it has been parsed
+@contextlib.contextmanager
+def page_slot():
+    slots = _page_slots
+    if slots is None:
+        yield
+        return
+    with metrics.timed('page_wait'):
+        slots.acquire()
+    try:
+        yield
+    finally:
+        slots.release()
+
+
+# Tags point at their parents and neighbours, so a dropped tree lingers
+# until the garbage collector finds the cycles. Clearing every tag
+# frees it on the spot. (Decomposing the root alone only clears the
+# root.)
+def release(soup):
+    for child in list(soup.contents):
+        child.decompose()
+
+
+# bs4 is only imported once there is a page to parse, so commands
+# that never parse anything start quickly
+def make_soup(sauce):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(
+        sauce, available_backend(),
+        parse_only=region() if settings['region_only'] else None
+    )
+
+
+# Compiled once per dictionary instead of on every lookup
+@functools.lru_cache()
+def header_pattern(url_id):
+    return re.compile(".+/cat/dictionary/{}.*".format(url_id))
+
+
+# Watches a page as it downloads and tells when every wanted section
+# is in: for each url_id, the section div after the dictionary's header
+# up to its closing tag. Only the newly arrived bytes are scanned each
+# time, counting <div> and </div> while skipping scripts and comments.
+class SectionEnd:
+    TAGS = re.compile(rb'<!--|<(script|style)\b|<div\b|</div\s*>', re.I)
+    CLOSERS = {b'<!--': b'-->', b'script': b'</script', b'style': b'</style'}
+    # Long enough for a tag cut in half between two chunks
+    TAIL = 64
+
+    def __init__(self, url_ids):
+        self.wanted = set(url_ids)
+        self.header = re.compile(
+            rb'/cat/dictionary/(' +
+            b'|'.join(re.escape(u.encode()) for u in self.wanted) + rb')\b'
+        )
+        classes = {r['section_class'] for r in jisho_config.values()
+                   if r['url_id'] in self.wanted}
+        self.section = re.compile(
+            rb'<div\b[^>]*\bclass="[^"]*\b(?:' +
+            b'|'.join(re.escape(c.encode()) for c in sorted(classes)) +
+            rb')\b[^>]*>'
+        )
+        self.pos = 0
+        # The section being read, and how many divs deep into it
+        self.current = None
+        self.depth = 0
+
+    def __call__(self, body):
+        while self.wanted:
+            if self.current is None:
+                if not self._find_section(body):
+                    return False
+            elif not self._find_end(body):
+                return False
+        return True
+
+    def _find_section(self, body):
+        header = self.header.search(body, self.pos)
+        if header is None:
+            self.pos = max(self.pos, len(body) - self.TAIL)
+            return False
+        kiji = self.section.search(body, header.end())
+        if kiji is None:
+            self.pos = header.start()
+            return False
+        self.current = header.group(1).decode()
+        self.depth = 1
+        self.pos = kiji.end()
+        return True
+
+    def _find_end(self, body):
+        for tag in self.TAGS.finditer(body, self.pos):
+            opener = tag.group(1) or tag.group(0)
+            closer = self.CLOSERS.get(opener.lower())
+            if closer is not None:
+                end = body.find(closer, tag.end())
+                if end < 0:
+                    # Wait for the rest of the script or comment
+                    self.pos = tag.start()
+                    return False
+                # Carry on scanning from after it
+                self.pos = end + len(closer)
+                return True
+            self.depth += -1 if tag.group(0).startswith(b'</') else 1
+            self.pos = tag.end()
+            if self.depth == 0:
+                self.wanted.discard(self.current)
+                self.current = None
+                return True
+        self.pos = max(self.pos, len(body) - self.TAIL)
+        return False
+
+
+# Picks headings for a term by one of the PICK_POLICIES. Returns an
+# index, a list of indexes, or DEFERRED.
+def pick(policy, term, candidates):
+    if policy == PICK_FIRST:
+        return 0
+    if policy == PICK_ALL:
+        return list(range(len(candidates)))
+    if policy == PICK_LATER:
+        return DEFERRED
+    if policy == PICK_MATCH_READING:
+        reading = to_hiragana(term)
+        for i, c in enumerate(candidates):
+            if (to_hiragana(c['yomigana']) == reading or
+                    term in index.spellings(c['heading'])):
+                return i
+        return 0
+    raise ValueError('unknown pick policy: {}'.format(policy))
+
+
+# Fetches and parses for each (term, url_id) that some lookup is
+# working on right now, so concurrent lookups of a term share them
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+# Calls fn() and returns what it returns, unless another thread is
+# already doing so for `key`; then that call's result (or exception)
+# is waited for and shared instead
+def single_flight(key, fn):
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+
+    if not leader:
+        metrics.count('coalesced')
+        return future.result()
+
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+class Scraper:
+    def __init__(self, term, jisho='daijirin', choose=None, verbose=False,
+                 candidates=None):
+        # Width variants and stray whitespace would miss the cache
+        self.term = cache.normalize_term(term)
+        self.jisho = jisho
+        self.jisho_name = jisho_config[self.jisho]['name']
+        self.url_id = jisho_config[self.jisho]['url_id']
+        # One of PICK_POLICIES, or a function called with the heading
+        # texts when there is more than one that returns the chosen
+        # index (or a list of them), or None if the user cancelled
+        self.choose = choose or PICK_FIRST
+        self.verbose = verbose
+        self.entry = None
+        self.entries = []
+        self.timings = {'fetch': 0.0, 'parse': 0.0}
+        self.data = self.scrape(candidates)
+
+    # `candidates` are the headings already parsed from a page holding
+    # several dictionaries (an empty list if it had none for this one).
+    # Without them the term's page is fetched and parsed.
+    def scrape(self, candidates=None):
+        if candidates is None:
+            candidates = single_flight(
+                (self.term, self.url_id, index.settings['offline']),
+                self.candidates
+            )
+        if candidates == NOT_FOUND_CACHED:
+            return NOT_FOUND_CACHED
+        if not candidates:
+            return None
+
+        if len(candidates) == 1:
+            chosen = 0
+        elif self.choose in PICK_POLICIES:
+            chosen = pick(self.choose, self.term, candidates)
+        else:
+            chosen = self.choose([c['heading'] for c in candidates])
+
+        if chosen is None:
+            return CANCELLED
+        if chosen == DEFERRED:
+            return DEFERRED
+        if not isinstance(chosen, list):
+            chosen = [chosen]
+
+        self.entries = [candidates[i] for i in chosen]
+        self.entry = self.entries[0]
+        return '\n'.join(c['html'] for c in self.entries)
+
+    # The parsed headings on the term's page, None if it has none, or
+    # NOT_FOUND_CACHED if it had none when last looked at
+    def candidates(self):
+        if index.settings['offline']:
+            return index.find(self.term, self.url_id)
+
+        with metrics.timed('cache'):
+            candidates = cache.get_entry(
+                self.term, self.url_id, PARSER_VERSION
+            )
+            known_miss = candidates is None and cache.is_miss(
+                self.term, self.url_id, PARSER_VERSION
+            )
+        if candidates is not None:
+            metrics.count('entry_hits')
+            return candidates
+        if known_miss:
+            metrics.count('miss_hits')
+            return NOT_FOUND_CACHED
+        metrics.count('entry_misses')
+
+        # Fetch initial page source
+        url = '{0}/content/{1}?dictCode={2}'.format(
+            session.WEBLIO_URL, quote(self.term, safe=''),
+            self.url_id.upper()
+        )
+        if self.verbose:
+            print('searching at ' + url)
+        with page_slot():
+            start = time.perf_counter()
+            sauce = cache.fetch_page(
+                self.term, self.url_id, url,
+                done=(SectionEnd([self.url_id])
+                      if settings['stop_early'] else None)
+            )
+            self.timings['fetch'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            candidates = extract(sauce, self.jisho, self.term)
+            self.timings['parse'] = time.perf_counter() - start
+            del sauce
+        with metrics.timed('store'):
+            if candidates is not None:
+                cache.put_entry(
+                    self.term, self.url_id, PARSER_VERSION, candidates
+                )
+                index.add(
+                    self.term, self.url_id, PARSER_VERSION, candidates
+                )
+            else:
+                # fetch_page() raises unless weblio answered, so this
+                # is a real miss and not a failed request
+                cache.put_miss(self.term, self.url_id, PARSER_VERSION)
+        return candidates
+
+
+# Looks up a single term, handing back errors in the result instead of
+# raising so that one failed term doesn't stop the rest of a batch.
+# `background` lookups give way to others at the rate limiter.
+def lookup(term, jisho='daijirin', choose=None, verbose=False,
+           background=False, candidates=None):
+    start = time.perf_counter()
+    try:
+        with ratelimit.background(background):
+            s = Scraper(term, jisho, choose=choose, verbose=verbose,
+                        candidates=candidates)
+    except Exception as e:
+        return Lookup(term, jisho, ERROR, None, None, e,
+                      {'total': time.perf_counter() - start}, [])
+
+    timings = dict(s.timings, total=time.perf_counter() - start)
+    if s.data is None:
+        status = NOT_FOUND
+    elif s.data in (CANCELLED, DEFERRED, NOT_FOUND_CACHED):
+        status = s.data
+    else:
+        status = FOUND
+    return Lookup(term, jisho, status, s.entry,
+                  s.data if status == FOUND else None, None, timings,
+                  s.entries)
+
+
+# Parsed headings for each of `jishos`, all taken from one fetch and
+# one parse of the page that holds every dictionary. Dictionaries
+# already in the cache, as entries or recent misses (or every one,
+# offline), don't need the page.
+def candidates_all(term, jishos, verbose=False):
+    term = cache.normalize_term(term)
+    found = {}
+    missing = []
+    for jisho in jishos:
+        url_id = jisho_config[jisho]['url_id']
+        if index.settings['offline']:
+            found[jisho] = index.find(term, url_id) or []
+            continue
+        with metrics.timed('cache'):
+            candidates = cache.get_entry(
+                term, url_id, PARSER_VERSION, page_id=ALL_DICTIONARIES
+            )
+            known_miss = candidates is None and cache.is_miss(
+                term, url_id, PARSER_VERSION
+            )
+        if candidates is not None:
+            metrics.count('entry_hits')
+            found[jisho] = candidates
+        elif known_miss:
+            metrics.count('miss_hits')
+            found[jisho] = NOT_FOUND_CACHED
+        else:
+            metrics.count('entry_misses')
+            missing.append(jisho)
+    if not missing:
+        return found, {'fetch': 0.0, 'parse': 0.0}
+
+    def fetch_and_parse():
+        timings = {}
+        url = '{0}/content/{1}'.format(
+            session.WEBLIO_URL, quote(term, safe='')
+        )
+        if verbose:
+            print('searching at ' + url)
+        with page_slot():
+            start = time.perf_counter()
+            # The page is cached for any set of dictionaries, so it is
+            # read until every dictionary's section is in
+            sauce = cache.fetch_page(
+                term, ALL_DICTIONARIES, url,
+                done=SectionEnd(
+                    [j['url_id'] for j in jisho_config.values()]
+                ) if settings['stop_early'] else None
+            )
+            timings['fetch'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            parsed = extract_all(sauce, missing, term)
+            timings['parse'] = time.perf_counter() - start
+            del sauce
+        with metrics.timed('store'):
+            for jisho, candidates in parsed.items():
+                url_id = jisho_config[jisho]['url_id']
+                if candidates is not None:
+                    cache.put_entry(
+                        term, url_id, PARSER_VERSION, candidates
+                    )
+                    index.add(term, url_id, PARSER_VERSION, candidates)
+                else:
+                    cache.put_miss(term, url_id, PARSER_VERSION)
+        return parsed, timings
+
+    parsed, timings = single_flight(
+        (term, ALL_DICTIONARIES, tuple(missing)), fetch_and_parse
+    )
+    for jisho, candidates in parsed.items():
+        found[jisho] = candidates or []
+    return found, timings
+
+
+# Looks a term up in several dictionaries at once, returning a Lookup
+# for each one in the order of `jishos`. With a single dictionary this
+# is just lookup(); with more the page is only fetched and parsed once.
+def lookup_all(term, jishos, choose=None, verbose=False, background=False):
+    if len(jishos) == 1:
+        return [lookup(term, jishos[0], choose, verbose, background)]
+
+    start = time.perf_counter()
+    try:
+        with ratelimit.background(background):
+            found, timings = candidates_all(term, jishos, verbose)
+    except Exception as e:
+        timings = {'total': time.perf_counter() - start}
+        return [Lookup(term, jisho, ERROR, None, None, e, timings, [])
+                for jisho in jishos]
+
+    results = []
+    for jisho in jishos:
+        result = lookup(term, jisho, choose, verbose,
+                        candidates=found[jisho])
+        # The fetch and parse were shared, so each result gets all of it
+        results.append(result._replace(timings=dict(
+            timings, total=time.perf_counter() - start)))
+    return results
+
+
+# Looks terms up on a pool of `concurrency` workers, yielding a Lookup
+# for each one as soon as it is ready (or in input order if `ordered`).
+# If `jisho` is a tuple of dictionaries, a list of Lookups from
+# lookup_all() is yielded for each term instead.
+# Terms are pulled from the iterable only as results are consumed, so
+# at most twice `concurrency` lookups are ever held at once.
+def iter_lookups(terms, jisho='daijirin', concurrency=4, choose=None,
+                 ordered=False, verbose=False, background=False):
+    look = lookup_all if isinstance(jisho, tuple) else lookup
+    terms = iter(terms)
+    window = concurrency * 2
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        def submit(count):
+            for term in terms:
+                pending.append(
+                    pool.submit(
+                        look, term, jisho, choose, verbose, background
+                    )
+                )
+                count -= 1
+                if count == 0:
+                    break
+
+        try:
+            submit(window)
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+
+                for future in done:
+                    yield future.result()
+                    submit(1)
+        finally:
+            # Stop queued lookups if the caller stopped early
+            for future in pending:
+                future.cancel()
+
+
+# Fetches and parses terms into the cache ahead of time, so looking
+# them up later needs no network. Runs at background priority and
+# yields a Lookup for each term as it finishes; already cached terms
+# finish right away.
+def prefetch(terms, jisho='daijirin', concurrency=2):
+    return iter_lookups(
+        terms, jisho, concurrency=concurrency, choose=PICK_FIRST,
+        background=True
+    )
+
+
+# Parses a page into a list of candidate entries, one per heading,
+# each holding its yomigana, definitions and rendered html.
+# Returns None if the page has nothing from the chosen dictionary.
+def extract(sauce, jisho, term):
+    with metrics.timed('soup'):
+        soup = make_soup(sauce)
+    try:
+        return extract_from(soup, jisho, term)
+    finally:
+        if settings['max_pages']:
+            release(soup)
+
+
+# The same for several dictionaries from one parse of the page,
+# as a dict of each dictionary's candidates (or None)
+def extract_all(sauce, jishos, term):
+    with metrics.timed('soup'):
+        soup = make_soup(sauce)
+    try:
+        return {jisho: extract_from(soup, jisho, term) for jisho in jishos}
+    finally:
+        if settings['max_pages']:
+            release(soup)
+
+
+def extract_from(soup, jisho, term):
+    with metrics.timed('walk'):
+        return _extract_from(soup, jisho, term)
+
+
+def _extract_from(soup, jisho, term):
+    candidates = plan(jisho).run(soup)
+    if not candidates:
+        return None
+
+    for c in candidates:
+        c['html'] = render(term, c)
+    return candidates
+
+
+# A dictionary's rules from jisho_config with the selectors compiled,
+# so each lookup only has to run them
+class Plan:
+    def __init__(self, rules):
+        import soupsieve
+
+        def compiled(selector):
+            return soupsieve.compile(selector) if selector else None
+
+        self.link = header_pattern(rules['url_id'])
+        self.header_class = rules['header_class']
+        self.section_class = rules['section_class']
+        self.heading = compiled(rules['heading'])
+        self.max_headings = rules['max_headings'] or 0
+        self.body = compiled(rules['body'])
+        self.items = compiled(rules['items'])
+        self.single = compiled(rules['single'])
+        self.reading = compiled(rules['reading'])
+        self.squash_spaces = rules['squash_spaces']
+
+    # Returns the candidates in the dictionary's section of `soup`,
+    # or None if the page doesn't have one
+    def run(self, soup):
+        # Find the header of the dictionary
+        link = soup.find('a', href=self.link)
+        header = link and link.find_parent('div', class_=self.header_class)
+        if header is None:
+            return None
+
+        # Finds the following element containing
+        # the dictionary's definitions
+        section = header.find_next_sibling('div', class_=self.section_class)
+        if section is None:
+            return None
+
+        candidates = []
+        for head in self.heading.select(section, limit=self.max_headings):
+            body = self.body_of(head)
+            if body is None:
+                continue
+
+            # Takes multi-definition entries and generates a list for output
+            items = self.items.select(body) if self.items else []
+            if len(items) > 1:
+                defs = [d.text for d in items]
+            # Checks for single definition
+            else:
+                single = self.single and self.single.select_one(body)
+                defs = [(single or body).text]
+            if self.squash_spaces:
+                defs = [''.join(d.split()) for d in defs]
+
+            reading = self.reading and self.reading.select_one(head)
+            candidates.append({
+                'heading': head.text,
+                'yomigana': reading.text if reading else '',
+                'definitions': defs,
+            })
+        return candidates
+
+    def body_of(self, head):
+        for sibling in head.next_siblings:
+            if getattr(sibling, 'name', None) and self.body.match(sibling):
+                return sibling
+        return None
+
+
+@functools.lru_cache()
+def plan(jisho):
+    return Plan(jisho_config[jisho])
+
+
+def render(term, candidate):
+    yomigana = candidate['yomigana']
+    # Omits repetitive yomigana if term is strictly in hiragana
+    if yomigana == term:
+        yomigana = ''
+
+    defs = candidate['definitions']
+
+    # Handle multiple definitions and parse html list
+    if len(defs) > 1:
+        body = "\n".join(
+            ['<ol>'] +
+            [('<li>' + d + '</li>') for d in defs] +
+            ['</ol>']
+        )
+    else:
+        body = '<br>\n' + defs[0]
+
+    return '【{0}】 {1}{2}'.format(term, yomigana, body)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Peak memory of a batch run as the word list grows. Three runs change
+one thing at a time: entries held until the end, as for terms given on
+the command line; entries printed as they go; and the memory-bounded
+mode of --max-pages on top, which parses a few pages at a time and
+tears each tree down straight away.
+
+    python benchmarks/bench_memory.py [jobs] [max pages] [sizes...]
+
+Lookups go to the local stand-in server with the cache and index off,
+so every term is fetched and parsed. Pages are read whole so the
+connections stay open; otherwise the server, which runs in this
+process, starts a thread for every lookup. Memory is measured with
+tracemalloc, so it covers Python's own allocations only (the server's
+included), above what was allocated before the run. Next to each peak
+is what was still allocated at the end of the run after
+gc.collect(), which separates what the run keeps from garbage that was
+only waiting for the collector.
+'''
+
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+import index
+import output
+import ratelimit
+import scraper
+import session
+from stub_server import FixtureServer, load_cases
+
+
+def measure(terms, jobs, max_pages, hold, path):
+    scraper.configure(max_pages=max_pages)
+    held = []
+
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    with output.DefinitionsFile(path) as sink:
+        for results in scraper.iter_lookups(terms, ('daijirin',),
+                                            concurrency=jobs, ordered=True):
+            for result in results:
+                sink.add(result)
+                if result.html is not None and hold:
+                    held.append(result.html)
+    peak = tracemalloc.get_traced_memory()[1]
+    gc.collect()
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    scraper.configure(max_pages=None)
+    return (peak - base) / 1024, (kept - base) / 1024
+
+
+def main():
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    max_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    sizes = [int(n) for n in sys.argv[3:]] or [25, 100, 400]
+
+    # The stub server doesn't need protecting like weblio does
+    ratelimit.configure(rate=10000, burst=10000, max_in_flight=100)
+    cache.configure(enabled=False)
+    index.configure(enabled=False)
+    scraper.configure(stop_early=False)
+    words = [c['term'] for c in load_cases() if c['jisho'] == 'daijirin']
+
+    print('\n{0} jobs, KB above the start of the run: peak / kept after '
+          'gc.collect()\n'.format(jobs))
+    print('  {0:<20}'.format('terms') +
+          ''.join('{0:>16}'.format(n) for n in sizes))
+
+    with FixtureServer() as server, tempfile.TemporaryDirectory() as tmp:
+        session.WEBLIO_URL = server.url
+        path = os.path.join(tmp, 'definitions.txt')
+        # Pay for the imports and the first connection before measuring
+        measure(words, jobs, None, False, path)
+
+        runs = (
+            ('held until the end', None, True),
+            ('printed as they go', None, False),
+            ('--max-pages {}'.format(max_pages), max_pages, False),
+        )
+        for name, cap, hold in runs:
+            results = [
+                measure([words[i % len(words)] for i in range(n)],
+                        jobs, cap, hold, path)
+                for n in sizes
+            ]
+            print('  {0:<20}'.format(name) + ''.join(
+                '{0:>9.0f} /{1:>5.0f}'.format(peak, kept)
+                for peak, kept in results))
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+'''
+Compares per-lookup latency of a bare requests.get() against the
+shared pooled session, using the local stub server.
+
+    python benchmarks/bench_session.py [lookups] [connect delay (ms)]
+
+The connect delay stands in for the TCP + TLS handshake to weblio;
+the default of 30 ms is on the low side for a trip to Japan.
+'''
+
+import os
+import sys
+import time
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ratelimit
+import session
+from stub_server import StubServer
+
+
+def timed(get, url, lookups):
+    samples = []
+    for i in range(lookups):
+        start = time.perf_counter()
+        get('{0}/content/{1}?dictCode=SSDJJ'.format(url, i)).content
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        'mean_ms': 1000 * sum(samples) / len(samples),
+        'p50_ms': 1000 * samples[len(samples) // 2],
+        'p95_ms': 1000 * samples[int(len(samples) * 0.95) - 1],
+    }
+
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.03
+
+    # The stub server doesn't need protecting like weblio does
+    ratelimit.configure(rate=10000, burst=10000, max_in_flight=100)
+
+    with StubServer(connect_delay=delay) as server:
+        bare = timed(requests.get, server.url, lookups)
+        bare_connections = server.connections
+
+        server.connections = 0
+        pooled = timed(session.fetch, server.url, lookups)
+        pooled_connections = server.connections
+
+    print('{0} lookups, {1:.0f} ms connect delay\n'.format(
+        lookups, delay * 1000))
+    for name, result, conns in (('requests.get', bare, bare_connections),
+                                ('session.fetch', pooled, pooled_connections)):
+        print('{0:<14} mean {1:7.2f} ms  p50 {2:7.2f} ms  '
+              'p95 {3:7.2f} ms  connections {4}'.format(
+                  name, result['mean_ms'], result['p50_ms'],
+                  result['p95_ms'], conns))
+    print('\nsaved per lookup: {0:.2f} ms'.format(
+        bare['mean_ms'] - pooled['mean_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+'''
+Measures how long the CLI takes to start for commands that never go
+online, and checks that they don't import requests, bs4 or pyperclip.
+
+    python benchmarks/bench_startup.py [runs]
+
+Each command runs in a fresh interpreter in an empty folder with its
+own cache, so nothing here reads or changes your definitions.txt.
+'''
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, 'jisho_scraper.py')
+
+COMMANDS = (['list'], ['clear'], ['cache', 'stats'])
+
+# Only the code paths that need these should pay for importing them
+HEAVY = ('requests', 'bs4', 'pyperclip')
+
+
+def run(argv, cwd, env):
+    start = time.perf_counter()
+    done = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + argv, cwd=cwd, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True
+    )
+    elapsed = time.perf_counter() - start
+
+    # Lines look like "import time:  self | cumulative | name"
+    imported = set()
+    for line in done.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.rsplit('|', 1)[1].strip()
+            imported.add(name.split('.')[0])
+    return elapsed, imported
+
+
+def median(samples):
+    return sorted(samples)[len(samples) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, DAIJIRIN_SCRAPER_HOME=tmp)
+
+        baseline = median(
+            [run(['-c', 'pass'], tmp, env)[0] for _ in range(runs)])
+        print('\nBare interpreter            {:7.1f} ms'.format(
+            1000 * baseline))
+
+        for argv in COMMANDS:
+            samples = []
+            for _ in range(runs):
+                elapsed, imported = run([CLI] + argv, tmp, env)
+                samples.append(elapsed)
+            heavy = [m for m in HEAVY if m in imported]
+            print('{0:<27} {1:7.1f} ms  heavy imports: {2}'.format(
+                ' '.join(argv), 1000 * median(samples),
+                ', '.join(heavy) or 'none'))
+
+        # What the commands above would cost if they imported everything
+        elapsed = median([
+            run(['-c', 'import requests, bs4'], tmp, env)[0]
+            for _ in range(runs)
+        ])
+        print('\nImporting requests and bs4  {:7.1f} ms\n'.format(
+            1000 * (elapsed - baseline)))
+
+
+if __name__ == '__main__':
+    main()
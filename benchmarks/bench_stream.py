@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+Compares reading whole weblio pages against stopping the download once
+the wanted dictionary's section is in, over the recorded pages in
+fixtures/ served by the local stand-in server.
+
+    python benchmarks/bench_stream.py [rounds] [bandwidth (KB/s)]
+
+Bytes are counted as they come off the wire, so with gzip they are
+the compressed bytes. The fixtures repeat the same ads over and over
+and compress far better than real pages do, so the gzip numbers
+understate what stopping early saves on weblio.
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ratelimit
+import scraper
+import session
+from jisho_config import jisho_config
+from stub_server import FixtureServer, load_cases
+
+
+def timed(server, cases, rounds, stop_early):
+    wire = []
+    samples = []
+    for _ in range(rounds):
+        for case in cases:
+            url_id = jisho_config[case['jisho']]['url_id']
+            url = '{0}/content/{1}?dictCode={2}'.format(
+                server.url, case['term'], url_id.upper())
+            section_end = scraper.SectionEnd([url_id])
+            read = []
+
+            def done(body):
+                read.append(response.raw.tell())
+                return stop_early and section_end(body)
+
+            start = time.perf_counter()
+            response = session.fetch(url, stream=True)
+            body = session.read_until(response, done)
+            got = scraper.extract(body, case['jisho'], case['term'])
+            samples.append(time.perf_counter() - start)
+
+            if got != case['expected']:
+                raise AssertionError('different results for {0} ({1})'
+                                     .format(case['term'], case['jisho']))
+            wire.append(read[-1] if read else 0)
+    return {
+        'kb': sum(wire) / len(wire) / 1024,
+        'ms': 1000 * sum(samples) / len(samples),
+    }
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    bandwidth = float(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 500 * 1024
+
+    # The stub server doesn't need protecting like weblio does
+    ratelimit.configure(rate=10000, burst=10000, max_in_flight=100)
+    cases = load_cases()
+
+    print('\n{0} pages per run, {1:.0f} KB/s\n'.format(
+        rounds * len(cases), bandwidth / 1024))
+    for compressed in (False, True):
+        with FixtureServer(gzip=compressed, bandwidth=bandwidth) as server:
+            # Both runs start with no open connections
+            session.configure()
+            whole = timed(server, cases, rounds, stop_early=False)
+            session.configure()
+            early = timed(server, cases, rounds, stop_early=True)
+
+        print('{0}'.format('gzip' if compressed else 'uncompressed'))
+        for name, r in (('whole page', whole), ('stop early', early)):
+            print('  {0:<12} {1:8.1f} KB read  {2:8.2f} ms to definition'
+                  .format(name, r['kb'], r['ms']))
+        print('  saved        {0:7.1f}%          {1:7.1f}%\n'.format(
+            100 * (1 - early['kb'] / whole['kb']),
+            100 * (1 - early['ms'] / whole['ms'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+'''
+Offline benchmark suite.
+
+Measures parse throughput over the recorded weblio pages in fixtures/
+for every installed parser backend, and end-to-end lookup latency
+through the local stand-in server, with and without the cache. Every
+parse is checked against the expected candidates in cases.json.
+
+    python benchmarks/run.py [--json results.json] [--compare old.json]
+
+Nothing here touches the network.
+'''
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+
+# Also puts the repository on sys.path for the imports below
+from stub_server import FixtureServer, load_cases, load_fixture
+
+import bs4
+import cache
+import index
+import scraper
+import ratelimit
+import session
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        'count': n,
+        'mean_ms': 1000 * sum(samples) / n,
+        'p50_ms': 1000 * samples[n // 2],
+        'p95_ms': 1000 * samples[max(0, int(n * 0.95) - 1)],
+        'p99_ms': 1000 * samples[max(0, int(n * 0.99) - 1)],
+    }
+
+
+def installed_backends():
+    backends = []
+    for backend in scraper.BACKENDS:
+        try:
+            bs4.BeautifulSoup('', backend)
+        except bs4.FeatureNotFound:
+            continue
+        backends.append(backend)
+    return backends
+
+
+def bench_parse(rounds):
+    cases = [(c, load_fixture(c['file'])) for c in load_cases()]
+    results = {}
+
+    for backend in installed_backends():
+        for region_only in (False, True):
+            scraper.configure(backend=backend, region_only=region_only)
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for case, sauce in cases:
+                    got = scraper.extract(sauce, case['jisho'], case['term'])
+                    if got != case['expected']:
+                        raise AssertionError('{0} gave different results '
+                                             'for {1} ({2})'.format(
+                                                 backend, case['term'],
+                                                 case['jisho']))
+            elapsed = time.perf_counter() - start
+
+            pages = rounds * len(cases)
+            name = '{0}{1}'.format(
+                backend, ' (region)' if region_only else ' (full page)')
+            results[name] = {
+                'pages': pages,
+                'pages_per_s': pages / elapsed,
+                'ms_per_page': 1000 * elapsed / pages,
+            }
+
+    scraper.configure(backend=None, region_only=True)
+    return results
+
+
+def bench_end_to_end(lookups, latency):
+    cases = load_cases()
+    results = {}
+
+    with FixtureServer(latency=latency) as server, \
+            tempfile.TemporaryDirectory() as tmp:
+        session.WEBLIO_URL = server.url
+        index.configure(path=os.path.join(tmp, 'index.sqlite'))
+
+        for name, enabled in (('no cache', False), ('cached', True)):
+            cache.configure(
+                enabled=enabled, path=os.path.join(tmp, 'cache.sqlite')
+            )
+            # Fill the cache first so the cached run only measures hits
+            if enabled:
+                for case in cases:
+                    scraper.Scraper(case['term'], case['jisho'])
+
+            samples = []
+            for i in range(lookups):
+                case = cases[i % len(cases)]
+                start = time.perf_counter()
+                scraper.Scraper(case['term'], case['jisho'])
+                samples.append(time.perf_counter() - start)
+            results[name] = summarize(samples)
+
+        # Everything is in the index by now
+        index.configure(offline=True)
+        samples = []
+        for i in range(lookups):
+            case = cases[i % len(cases)]
+            start = time.perf_counter()
+            scraper.Scraper(case['term'], case['jisho'])
+            samples.append(time.perf_counter() - start)
+        results['offline index'] = summarize(samples)
+
+        cache.configure(enabled=True, path=None)
+        index.configure(offline=False, path=None)
+
+    return results
+
+
+# Every dictionary for a term: one lookup per dictionary, against one
+# lookup_all() that fetches and parses the page once
+def bench_multi(lookups, latency):
+    terms = sorted({case['term'] for case in load_cases()})
+    jishos = tuple(scraper.jisho_config)
+    results = {}
+
+    with FixtureServer(latency=latency) as server:
+        session.WEBLIO_URL = server.url
+        # Nothing from the fixtures should reach the user's own cache
+        # or index
+        cache.configure(enabled=False)
+        index.configure(enabled=False)
+
+        runs = (
+            ('separate', lambda term: [
+                scraper.lookup(term, jisho) for jisho in jishos]),
+            ('one fetch', lambda term: scraper.lookup_all(term, jishos)),
+        )
+        for name, look in runs:
+            requests = server.requests
+            samples = []
+            for i in range(lookups):
+                start = time.perf_counter()
+                look(terms[i % len(terms)])
+                samples.append(time.perf_counter() - start)
+            results[name] = summarize(samples)
+            results[name]['requests'] = server.requests - requests
+
+        cache.configure(enabled=True, path=None)
+        index.configure(enabled=True)
+
+    return results
+
+
+def compare(old, new, path=()):
+    for key, value in new.items():
+        if isinstance(value, dict):
+            compare(old.get(key, {}), value, path + (key,))
+        elif key in ('count', 'pages', 'requests'):
+            continue
+        elif (isinstance(value, (int, float)) and
+                isinstance(old.get(key), (int, float)) and old[key]):
+            print('{0:<52} {1:>10.2f} -> {2:>10.2f}  ({3:+.1f}%)'.format(
+                ' / '.join(path + (key,)), old[key], value,
+                100 * (value - old[key]) / old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='passes over the fixtures per parser setup')
+    parser.add_argument('--lookups', type=int, default=200,
+                        help='end-to-end lookups per run')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='simulated weblio response time in ms')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results file of an earlier run')
+    args = parser.parse_args()
+
+    # The stand-in server doesn't need protecting like weblio does
+    ratelimit.configure(rate=10000, burst=10000, max_in_flight=100)
+
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'bs4': bs4.__version__,
+        'settings': vars(args),
+        'parse': bench_parse(args.rounds),
+        'end_to_end': bench_end_to_end(args.lookups, args.latency / 1000),
+        'multi': bench_multi(args.lookups // 4, args.latency / 1000),
+    }
+
+    print('\nParse throughput')
+    for name, r in results['parse'].items():
+        print('  {0:<26} {1:8.1f} pages/s  {2:7.2f} ms/page'.format(
+            name, r['pages_per_s'], r['ms_per_page']))
+
+    print('\nEnd-to-end lookup latency '
+          '({:.0f} ms simulated server time)'.format(args.latency))
+    for name, r in results['end_to_end'].items():
+        print('  {0:<26} mean {1:7.2f} ms  p50 {2:7.2f} ms  '
+              'p95 {3:7.2f} ms'.format(
+                  name, r['mean_ms'], r['p50_ms'], r['p95_ms']))
+
+    print('\nEvery dictionary for a term, uncached')
+    for name, r in results['multi'].items():
+        print('  {0:<26} mean {1:7.2f} ms  p95 {2:7.2f} ms  '
+              '{3} requests'.format(
+                  name, r['mean_ms'], r['p95_ms'], r['requests']))
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            old = json.load(f)
+        print('\nCompared with ' + args.compare)
+        compare(old, {'parse': results['parse'],
+                      'end_to_end': results['end_to_end'],
+                      'multi': results['multi']})
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print('\nSaved results to ' + args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Local stand-in for www.weblio.jp used by the benchmarks.
+
+It speaks keep-alive HTTP/1.1 and can add a delay to every new
+connection to mimic the TCP + TLS handshake cost of the real site,
+and a delay to every response to mimic its server time. It can also
+gzip its responses and send them at a limited rate, to mimic a page
+arriving over a real link.
+
+FixtureServer answers /content/<term>?dictCode=<code> with the pages
+in fixtures/, as listed in fixtures/cases.json. Without a dictCode it
+answers with the term's page from any of its cases, as every fixture
+holds all the dictionaries weblio shows for its term.
+'''
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, 'fixtures')
+
+sys.path.insert(0, os.path.dirname(HERE))
+
+from jisho_config import jisho_config
+
+DEFAULT_PAGE = (
+    '<html><body><div class="pbarT"><a href="/cat/dictionary/ssdjj">'
+    '大辞林</a></div></body></html>'
+).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this the
+    # client's delayed ACK stalls every keep-alive response
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, body = self.server.page_for(self.path)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if (self.server.gzip and
+                'gzip' in self.headers.get('Accept-Encoding', '')):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+        step = 4096
+        try:
+            for i in range(0, len(body), step):
+                self.wfile.write(body[i:i + step])
+                self.wfile.flush()
+                time.sleep(step / self.server.bandwidth)
+        except ConnectionError:
+            # The client had what it needed and hung up
+            self.close_connection = True
+
+    # Keeps the benchmark output readable
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # bandwidth is in bytes per second, or 0 for as fast as possible
+    def __init__(self, page=DEFAULT_PAGE, connect_delay=0.0, latency=0.0,
+                 gzip=False, bandwidth=0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.page = page
+        self.connect_delay = connect_delay
+        self.latency = latency
+        self.gzip = gzip
+        self.bandwidth = bandwidth
+        self.connections = 0
+        self.requests = 0
+
+    # Returns the status and body to answer a request for path with
+    def page_for(self, path):
+        return 200, self.page
+
+    # Clients that stop reading a page early hang up on the server
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+# The recorded lookups: term, jisho, fixture file, the status weblio
+# answered with and the candidates the scraper should extract
+def load_cases():
+    with open(os.path.join(FIXTURES, 'cases.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+class FixtureServer(StubServer):
+    def __init__(self, connect_delay=0.0, latency=0.0, gzip=False,
+                 bandwidth=0):
+        super().__init__(connect_delay=connect_delay, latency=latency,
+                         gzip=gzip, bandwidth=bandwidth)
+        self.pages = {}
+        for case in load_cases():
+            dict_code = jisho_config[case['jisho']]['url_id'].upper()
+            page = (case['status'], load_fixture(case['file']))
+            self.pages[(case['term'], dict_code)] = page
+            self.pages.setdefault((case['term'], ''), page)
+        self.not_found = (404, load_fixture('not_found.html'))
+
+    def page_for(self, path):
+        url = urlsplit(path)
+        term = unquote(url.path.rsplit('/', 1)[-1])
+        dict_code = parse_qs(url.query).get('dictCode', [''])[0].upper()
+        return self.pages.get((term, dict_code), self.not_found)
@@ -1,16 +1,46 @@
+# How to read each dictionary's section of a weblio page.
+#
+# header_class and section_class are the classes of the div holding the
+# link to the dictionary (/cat/dictionary/<url_id>) and of the div after
+# it holding its entries. The rest are CSS selectors, matched inside
+# that section:
+#
+#   heading  each entry's heading (at most max_headings of them)
+#   body     the first sibling after a heading that holds its text
+#   items    a definition each, when the body has more than one
+#   single   the definition inside the body otherwise (else the body)
+#   reading  inside the heading, the yomigana (None if there isn't one)
+#
+# squash_spaces removes all whitespace from definitions. A dictionary
+# read the same way as these only needs an entry here.
 jisho_config = {
 
     'daijirin': {
         'name': '大辞林',
         'url_id': 'ssdjj',
         'header_class': 'pbarT',
-        'body_class': 'NetDicBody',
+        'section_class': 'kijiWrp',
+        'heading': 'div.NetDicHead',
+        'max_headings': None,
+        'body': 'div.NetDicBody',
+        'items': 'span[style="text-indent:0;"]',
+        'single': 'div div div',
+        'reading': 'b',
+        'squash_spaces': True,
     },
 
     'wikipedia': {
         'name': 'ウィキペディア',
         'url_id': 'wkpja',
-        'header_class': 'Wkpja',
+        'header_class': 'pbarT',
+        'section_class': 'kijiWrp',
+        'heading': 'h2.midashigo',
+        'max_headings': 1,
+        'body': 'div.Wkpja',
+        'items': None,
+        'single': 'p:not([class])',
+        'reading': None,
+        'squash_spaces': False,
     },
 
 }
@@ -10,210 +10,566 @@ This addon was created to grab and parse definitions from the
 License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
 '''
 
+import json
 import os
 import sys
-import requests
-from bs4 import BeautifulSoup
-import re
-import pyperclip
+import threading
+import time
+from collections import Counter, deque
 from jisho_config import jisho_config
+import scraper
+from scraper import (
+    PARSER_VERSION, iter_lookups, lookup, prefetch, ERROR, FOUND, NOT_FOUND,
+    NOT_FOUND_CACHED, DEFERRED,
+    PICK_FIRST, PICK_ALL, PICK_MATCH_READING, PICK_LATER
+)
+import session
+import cache
+import index
+import metrics
+import ratelimit
+import output
 
 # Comment this out to see tracebacks for debugging
 # sys.tracebacklimit = None
 
+# Keeps concurrent lookups from prompting on the console at the same time
+prompt_lock = threading.Lock()
 
-class Scraper:
-    def __init__(self, term, jisho='daijirin'):
-        self.term = term
-        self.jisho = jisho
-        self.jisho_name = jisho_config[self.jisho]['name']
-        self.url_id = jisho_config[self.jisho]['url_id']
-        self.data = self.scrape()
-
-    def scrape(self):
-        # Fetch initial page source
-        url = 'https://www.weblio.jp/content/{0}?dictCode={1}'.format(
-            self.term, self.url_id.upper() )
-        print('searching at ' + url)
-        sauce = requests.get(url).content
-        soup = BeautifulSoup(sauce, 'html.parser')
-
-        # Find the header of selected dictionary
-        header_url = soup.find('a', href=re.compile(
-            ".+/cat/dictionary/{}.*".format(self.url_id))
-        )
-
-        try:
-            header = header_url.find_parent('div', class_='pbarT')
-        except:
-            header = None
-            pass
-
-        if header is None:
-            return None
-
-        # Finds the following element containing
-        # the chosen dictionary's definitions
-        entry = header.find_next_sibling('div', class_='kijiWrp')
-
-        # Outputs Daijirin header(s) to a list for the user to choose from
-        def parse_daijirin_def():
-            data = {}
-
-            entry_heads = entry.find_all('div', class_='NetDicHead')
-            
-            def choose_header(header_list):
-                if len(header_list) > 1:
-                    # If there is more than one entry head,
-                    # user must choose one from the console.
-                    print(
-                        "Choose which one you would like by typing " +
-                        "the entry's number and press Enter:\n"
-                    )
-
-                    for q, choices in enumerate(header_list, 1):
-                        text = choices.text.encode('utf-8')
-                        print(u'{0}. '.format(q) + text.decode('utf-8'))
-
-                    # The extra space looks clean :)
-                    print('')
-
-                    # Checks if the user's input is a valid number
-                    while True:
-                        try:
-                            chosen = header_list[int(input()) - 1]
-                            break
-                        except IndexError:
-                            print("Error: enter a number that's on the list.")
-                            continue
-                # If there is only one header, it will be selected
-                # automatically for extracting defintions
-                else:
-                    chosen = header_list[0]
-                return chosen
 
-            # Runs the above function to get the proper header
-            chosen_head = choose_header(entry_heads)
-            chosen_body = chosen_head.find_next_sibling(
-                'div', class_='NetDicBody'
-            )
-
-            # Takes multi-definition entries and generates a list for output
-            defs = chosen_body.find_all('span', style="text-indent:0;")
+# Asks on the console which heading to use when a page has several
+def choose_header(headings):
+    # Only one worker can prompt at a time
+    with prompt_lock:
+        print(
+            "Choose which one you would like by typing " +
+            "the entry's number and press Enter:\n"
+        )
 
-            data['yomigana'] = chosen_head.find('b').text
-            # Omits repetitive yomigana if term is strictly in hiragana
-            if data['yomigana'] == self.term:
-                data['yomigana'] = ''
+        for q, heading in enumerate(headings, 1):
+            print(u'{0}. '.format(q) + heading)
 
-            # Handle multiple definitions and parse html list
-            if len(defs) > 1:
-                defs = [d.text for d in defs]
-                # Removes extra whitespaces in the definition strings
-                stripped = ["".join(piece.split()) for piece in defs]
+        # The extra space looks clean :)
+        print('')
 
-                data['body'] = "\n".join(
-                    ['<ol>'] +
-                    [('<li>' + d + '</li>') for d in stripped] +
-                    ['</ol>']
-                )
+        # Checks if the user's input is a valid number
+        while True:
+            try:
+                chosen = int(input()) - 1
+                headings[chosen]
+                return chosen
+            except (IndexError, ValueError):
+                print("Error: enter a number that's on the list.")
+                continue
 
-            # Checks for single definition and parses it in the html
-            else:
-                single_def = chosen_body.select_one("div div div").text
-                data['body'] = '<br>\n' + "".join(single_def.split())
 
-            return data
+# Prints what went wrong for a lookup that found nothing, and hands the
+# lookup to `sink` to be saved. Returns the entry's html, if any.
+def report(result, sink):
+    if result.status != DEFERRED:
+        sink.add(result)
 
-        def parse_wiki_def():
-            data = {}
+    if result.status == ERROR:
+        print(
+            "\nCould not look up '" + result.term + "': " +
+            str(result.error) + "\n"
+        )
+    elif result.status == FOUND:
+        return result.html
+    elif result.status == NOT_FOUND:
+        print(
+            "\nNo " + jisho_config[result.jisho]['name'] +
+            " definitions found for '" + result.term +
+            "'.\nCheck your input or try another dictionary.\n"
+        )
+    elif result.status == NOT_FOUND_CACHED:
+        print(
+            "\nNo " + jisho_config[result.jisho]['name'] +
+            " definitions found for '" + result.term +
+            "' when it was last looked up.\nRun 'daijirin cache " +
+            "purge-misses " + result.term + "' to check weblio again.\n"
+        )
+    return None
+
+
+# Pulls an '--option value' (or '--option=value') pair out of the
+# argument list and returns the value along with the remaining args
+def pop_option(args, name, default=None):
+    value = default
+    remaining = []
+    args = iter(args)
+    for a in args:
+        if a == name:
+            value = next(args, None)
+            if value is None:
+                raise ValueError('{} needs a value.'.format(name))
+        elif a.startswith(name + '='):
+            value = a.split('=', 1)[1]
+        else:
+            remaining.append(a)
+    return value, remaining
+
+
+# Streams terms from a word list (or stdin for '-'), one per line,
+# skipping the first `skip` lines. If `linenos` is given, the line number
+# of every term handed out is appended to it so finished lookups can be
+# traced back.
+def read_terms(path, skip=0, linenos=None):
+    word_list = sys.stdin if path == '-' else open(path, encoding='utf-8-sig')
+    try:
+        for lineno, line in enumerate(word_list, 1):
+            term = line.strip()
+            if lineno > skip and term:
+                if linenos is not None:
+                    linenos.append(lineno)
+                yield term
+    finally:
+        if word_list is not sys.stdin:
+            word_list.close()
+
+
+# Number of word list lines already looked up by an interrupted run,
+# and the [term, dictionary] pairs from them still waiting for a
+# heading to be picked. Older checkpoints only hold the terms, which
+# get None for the run's dictionary.
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return 0, []
+    deferred = [
+        [d, None] if isinstance(d, str) else d
+        for d in saved.get('deferred', [])
+    ]
+    return int(saved['lines']), deferred
+
+
+def save_checkpoint(path, lines, deferred):
+    # Written to the side and renamed so a crash can't leave half a file
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'lines': lines, 'deferred': deferred}, f,
+                  ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+# Save the checkpoint after this many finished terms
+CHECKPOINT_EVERY = 25
+
+
+# Handles 'cache stats|prune|clear|purge-misses [TERM...]'
+def cache_command(action='stats', terms=()):
+    if action == 'stats':
+        info = cache.stats()
+        print(
+            '\n' + info['path'] +
+            '\n{0} pages, {1:.1f} of {2:.1f} MB used, {3} stale, '
+            '{4} parsed, {5} known misses\n'.format(
+                info['entries'], info['bytes'] / 1024 ** 2,
+                info['max_bytes'] / 1024 ** 2, info['stale'],
+                info['parsed'], info['misses'])
+        )
+    elif action == 'prune':
+        print('\nRemoved {} stale pages from the cache.\n'.format(
+            cache.prune(PARSER_VERSION)))
+    elif action == 'clear':
+        print('\nRemoved {} pages from the cache.\n'.format(
+            cache.clear()))
+    elif action == 'purge-misses':
+        # Every miss, or only those of the terms given
+        print('\nForgot {} terms that had no entry.\n'.format(
+            cache.purge_misses(terms or None)))
+    else:
+        raise ValueError(
+            "unknown cache command '" + action +
+            "'. Use stats, prune, clear or purge-misses."
+        )
 
-            chosen_head = entry.find('h2', class_='midashigo')
-            chosen_body = chosen_head\
-                .find_next_sibling('div', class_="Wkpja")\
-                .find('p', class_=None)\
-                .text
 
-            data['yomigana'] = ''
-            data['body'] = '<br>\n' + chosen_body
+# Handles 'index stats|build|export PATH|import PATH|clear'
+def index_command(action='stats', path=None):
+    if action in ('export', 'import') and path is None:
+        raise ValueError('index ' + action + ' needs a file name.')
+
+    if action == 'stats':
+        info = index.stats()
+        print('\n' + info['path'] +
+              '\n{0} terms under {1} keys\n'.format(
+                  info['terms'], info['keys']))
+    elif action == 'build':
+        print('\nIndexed {} cached terms.\n'.format(index.build()))
+    elif action == 'export':
+        print('\nExported {0} terms to {1}\n'.format(
+            index.export(path), path))
+    elif action == 'import':
+        print('\nImported {0} terms from {1}\n'.format(
+            index.load(path), path))
+    elif action == 'clear':
+        print('\nRemoved {} terms from the index.\n'.format(
+            index.clear()))
+    else:
+        raise ValueError(
+            "unknown index command '" + action +
+            "'. Use stats, build, export, import or clear."
+        )
 
-            return data
 
-        def parse_action(dictionary):
-            return {
-                'daijirin': parse_daijirin_def,
-                'wikipedia': parse_wiki_def
-            }[dictionary]()
+# Answers lookups over HTTP until interrupted
+def serve_command(args):
+    host, args = pop_option(args, '--host', '127.0.0.1')
+    port, args = pop_option(args, '--port', '8750')
+    jobs, args = pop_option(args, '--jobs', '4')
+    if args:
+        raise ValueError('unknown serve options: ' + ' '.join(args))
+
+    # Only this command needs the HTTP server
+    import server
+    server.serve(host, int(port), int(jobs))
+
+
+# Fills the cache with the terms given on the command line or in a
+# word list, without writing anything to definitions.txt
+def prefetch_command(args, input_path=None):
+    call_jisho = 'daijirin'
+
+    if "--wiki" in args:
+        call_jisho = 'wikipedia'
+        args = [a for a in args if a != "--wiki"]
+
+    if "--no-cache" in args:
+        raise ValueError("prefetch only fills the cache, so it can't "
+                         "be used with --no-cache.")
+
+    jobs, args = pop_option(args, '--jobs', '2')
+    jobs = int(jobs)
+    if jobs < 1:
+        raise ValueError('--jobs must be at least 1.')
+
+    rate, args = pop_option(args, '--rate')
+    if rate is not None:
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError('--rate must be more than 0.')
+        ratelimit.configure(rate=rate)
+
+    unknown = [a for a in args if a.startswith('--')]
+    if unknown:
+        raise ValueError('unknown prefetch options: ' + ' '.join(unknown))
+
+    if input_path is None:
+        if len(args) == 0:
+            raise ValueError('no terms given to prefetch.')
+        terms = args
+    elif len(args) > 0:
+        raise ValueError(
+            'give terms on the command line or with --input, not both.'
+        )
+    else:
+        terms = read_terms(input_path)
+
+    summary = Counter()
+    started = time.perf_counter()
+    for result in prefetch(terms, call_jisho, concurrency=jobs):
+        summary[result.status] += 1
+        if result.status == ERROR:
+            print('Failed to fetch ' + result.term + ': ' +
+                  str(result.error))
+
+    elapsed = time.perf_counter() - started
+    print(
+        '\nPrefetched {0} terms in {1:.1f}s: {2} found, {3} not found, '
+        '{4} known misses, {5} errors\n'.format(
+            sum(summary.values()), elapsed, summary[FOUND],
+            summary[NOT_FOUND], summary[NOT_FOUND_CACHED], summary[ERROR])
+    )
+
+
+# Looks up the terms given on the command line or in a word list
+def lookup_command(args, input_path=None, checkpoint=None, out_path=None):
+    jishos = ('daijirin',)
+
+    if any("--wiki" in a for a in args):
+        jishos = ('wikipedia',)
+        args = [a for a in args if a != "--wiki"]
+
+    # Several dictionaries, all read from one fetch of the term's page
+    dicts, args = pop_option(args, '--dicts')
+    if dicts is not None:
+        jishos = tuple(d.strip() for d in dicts.split(',') if d.strip())
+        unknown = [d for d in jishos if d not in jisho_config]
+        if unknown or not jishos:
+            raise ValueError(
+                "unknown --dicts '" + dicts + "'. Use a comma separated "
+                "list of " + ', '.join(jisho_config) + '.'
+            )
 
-        definition = parse_action(self.jisho)
+    if "--no-cache" in args:
+        cache.configure(enabled=False)
+        args = [a for a in args if a != "--no-cache"]
+
+    # Answer from the local index only
+    if "--offline" in args:
+        index.configure(offline=True)
+        args = [a for a in args if a != "--offline"]
+
+    # BeautifulSoup tree builder, if not the fastest one installed
+    backend, args = pop_option(args, '--parser')
+    if backend is not None:
+        scraper.configure(backend=backend)
+
+    # Number of terms to fetch and parse at the same time
+    jobs, args = pop_option(args, '--jobs', '1')
+    jobs = int(jobs)
+    if jobs < 1:
+        raise ValueError('--jobs must be at least 1.')
+
+    # Requests per second sent to weblio, however many jobs there are
+    rate, args = pop_option(args, '--rate')
+    if rate is not None:
+        rate = float(rate)
+        if rate <= 0:
+            raise ValueError('--rate must be more than 0.')
+        ratelimit.configure(rate=rate)
+
+    # Memory-bounded mode: at most this many pages held at once
+    max_pages, args = pop_option(args, '--max-pages')
+    if max_pages is not None:
+        max_pages = int(max_pages)
+        if max_pages < 1:
+            raise ValueError('--max-pages must be at least 1.')
+        scraper.configure(max_pages=max_pages)
+
+    # Keep enough pooled connections open for every worker
+    session.configure(
+        pool_size=max(jobs, session.settings['pool_size'])
+    )
+
+    # Entries are written to definitions.txt in batches of this size
+    flush_every, args = pop_option(args, '--flush-every', '20')
+
+    # What to write the results as (and where, from --output)
+    out_format, args = pop_option(args, '--format', 'html')
+    if out_format not in output.FORMATS:
+        raise ValueError(
+            "unknown --format '" + out_format + "'. Use " +
+            ', '.join(output.FORMATS) + '.'
+        )
 
-        html = '【{0}】 {1}{2}'.format(
-            self.term, definition['yomigana'], definition['body']
+    # How to pick between several headings on one page
+    pick, args = pop_option(args, '--pick', 'interactive')
+    policies = {
+        'interactive': choose_header,
+        'first': PICK_FIRST,
+        'all': PICK_ALL,
+        'match-reading': PICK_MATCH_READING,
+        # Ambiguous terms wait in `deferred` until the rest are done
+        'interactive-later': PICK_LATER,
+    }
+    if pick not in policies:
+        raise ValueError(
+            "unknown --pick '" + pick + "'. Use " +
+            ', '.join(policies) + '.'
         )
-        return html
+    choose = policies[pick]
 
+    linenos = deque()
+    done_lines = 0
+    deferred = []
 
-# Pushes complete entry into final output text file
-def write_txt_file(txt):
-    text_file = open('definitions.txt', 'ab')
-    # checks if definitions.txt is empty or not
-    if os.stat("definitions.txt").st_size == 0:
-        text_file.write(txt.encode('utf-8'))
+    if input_path is None:
+        if len(args) == 0:
+            raise ValueError('no terms given. I need a search term pal.')
+        terms = args
     else:
-        text_file.write(
-            ('\n\n<div>' + txt + '</div>').encode('utf-8')
+        if len(args) > 0:
+            raise ValueError(
+                'give terms on the command line or with --input, '
+                'not both.'
+            )
+        if checkpoint is None and input_path != '-':
+            checkpoint = input_path + '.checkpoint'
+        if checkpoint is not None:
+            done_lines, deferred = load_checkpoint(checkpoint)
+            if done_lines:
+                print('Resuming after line {0} of {1}'.format(
+                    done_lines, input_path))
+        # stdin is busy with the word list, so it can't be used to
+        # pick between headings; the first heading is taken instead
+        if input_path == '-':
+            if choose == PICK_LATER:
+                raise ValueError(
+                    "--pick interactive-later can't ask which heading "
+                    "to use when the word list comes from stdin."
+                )
+            if choose == choose_header:
+                choose = PICK_FIRST
+        terms = read_terms(input_path, done_lines, linenos)
+
+    # Entries for terms given on the command line are printed together
+    # at the end, unless memory is bounded
+    accumulator = []
+    hold = input_path is None and max_pages is None
+    # Results by status, and how many terms they came from
+    summary = Counter()
+    looked_up = 0
+    started = time.perf_counter()
+
+    sink = output.FORMATS[out_format](
+        out_path, flush_every=int(flush_every)
+    )
+
+    try:
+        # Results come back in input order, so the output file and
+        # console match the order the terms were given in
+        for results in iter_lookups(terms, jishos, concurrency=jobs,
+                                    choose=choose, ordered=True,
+                                    verbose=True):
+            for result in results:
+                summary[result.status] += 1
+
+                if result.status == DEFERRED:
+                    deferred.append([result.term, result.jisho])
+
+                html = report(result, sink)
+                if html is not None:
+                    # Word lists are printed as they go rather than
+                    # held until the end, so memory stays flat
+                    if hold:
+                        accumulator.append(html)
+                    else:
+                        print('\n' + html + '\n')
+
+            looked_up += 1
+            if linenos:
+                done_lines = linenos.popleft()
+                if (checkpoint is not None and
+                        looked_up % CHECKPOINT_EVERY == 0):
+                    sink.flush()
+                    save_checkpoint(checkpoint, done_lines, deferred)
+
+        # Now that no workers are waiting, ask about the terms that
+        # had more than one heading. Their pages are already cached.
+        if deferred:
+            print('\n{} terms have more than one entry.\n'.format(
+                len(deferred)))
+        while deferred:
+            term, jisho = deferred[0]
+            result = lookup(term, jisho or jishos[0],
+                            choose=choose_header, verbose=True)
+            summary[DEFERRED] -= 1
+            summary[result.status] += 1
+
+            html = report(result, sink)
+            if html is not None:
+                if hold:
+                    accumulator.append(html)
+                else:
+                    print('\n' + html + '\n')
+            deferred.pop(0)
+    finally:
+        # Entries have to be on disk before the checkpoint says so
+        sink.close()
+        if checkpoint is not None and input_path is not None:
+            save_checkpoint(checkpoint, done_lines, deferred)
+
+    if input_path is None:
+        if accumulator:
+            print('\n' + '\n\n'.join(accumulator) + '\n')
+    else:
+        # The whole list is done, so there is nothing to resume
+        if checkpoint is not None:
+            os.remove(checkpoint)
+
+        elapsed = time.perf_counter() - started
+        print(
+            '\n{0} terms in {1:.1f}s ({2:.1f} terms/s): {3} found, '
+            '{4} not found, {5} known misses, {6} errors\n'.format(
+                looked_up, elapsed, looked_up / elapsed if elapsed else 0,
+                summary[FOUND], summary[NOT_FOUND],
+                summary[NOT_FOUND_CACHED], summary[ERROR])
         )
 
 
-# Clears the text file if the 'clear' argument is passed
-def clear():
-    clear_file = open('definitions.txt', 'w')
-    clear_file.write('')
+# Hands the arguments to the command they name
+def run(args, input_path=None, checkpoint=None, out_path=None):
+    if args[:1] == ['cache']:
+        cache_command(*args[1:2], terms=args[2:])
 
+    elif args[:1] == ['index']:
+        index_command(*args[1:3])
 
-# Initialize!
-args = sys.argv[1:]
+    elif args[:1] == ['serve']:
+        serve_command(args[1:])
 
-if len(args) == 0:
-    raise ValueError('no terms given. I need a search term pal.')
+    elif args[:1] == ['prefetch']:
+        prefetch_command(args[1:], input_path)
 
-else:
-    if any("list" in a for a in args):
-        if os.stat("definitions.txt").st_size == 0:
+    elif any("list" in a for a in args):
+        definitions = output.read()
+        if definitions == '':
             print("\nThere's no definitions to show!\n")
         else:
-            read_file = open('definitions.txt', 'rb')
-            print('\n', read_file.read().decode('utf-8'), '\n')
+            print('\n', definitions, '\n')
 
     elif any("cut" in a for a in args):
-        # Reads the file as bytes ('r+b')
-        copy_file = open('definitions.txt', 'r+b').read()
-        # Encodes the bytes to utf-8 and copies text to clipboard
-        pyperclip.copy(copy_file.decode('utf-8'))
-        # Clears the contents of the file
-        clear()
+        # Only this command needs the clipboard
+        import pyperclip
+        # Copies the definitions to the clipboard and clears the file
+        output.cut(pyperclip.copy)
 
     elif any("clear" in a for a in args):
-        clear()
+        output.clear()
 
     else:
-        call_jisho = 'daijirin'
-
-        if any("--wiki" in a for a in args):
-            call_jisho = 'wikipedia'
-            args = [a for a in args if a != "--wiki"]
-
-        accumulator = []
-        for term in args:
-            item = Scraper(term, call_jisho).data
-            if item:
-                write_txt_file(item)
-                accumulator.append(item)
-            else:
-                print(
-                    "\nNo " + jisho_config[call_jisho]['name'] +
-                    " definitions found for '" + term +
-                    "'.\nCheck your input or try another dictionary.\n"
-                )
+        lookup_command(args, input_path, checkpoint, out_path)
+
+
+# How long cached pages and misses are kept (in days) and how big the
+# cache can grow (in MB), for every command that uses the cache
+def cache_options(args):
+    limits = {}
+    for name, key, scale in (('--cache-ttl', 'ttl', 24 * 60 * 60),
+                             ('--miss-ttl', 'miss_ttl', 24 * 60 * 60),
+                             ('--cache-max-mb', 'max_bytes', 1024 * 1024)):
+        value, args = pop_option(args, name)
+        if value is not None:
+            value = float(value)
+            if value < 0:
+                raise ValueError(name + " can't be less than 0.")
+            limits[key] = int(value * scale)
+    if limits:
+        cache.configure(**limits)
+    return args
+
+
+def main(argv=None):
+    args = sys.argv[1:] if argv is None else list(argv)
+
+    # Pulled out first so a file name can't be mistaken for a command
+    input_path, args = pop_option(args, '--input')
+    checkpoint, args = pop_option(args, '--checkpoint')
+    out_path, args = pop_option(args, '--output')
+    args = cache_options(args)
+
+    # Time each phase of the run and print (or save) a summary at the end
+    profile = '--profile' in args
+    args = [a for a in args if a != '--profile']
+    profile_out, args = pop_option(args, '--profile-out')
+    if profile or profile_out:
+        metrics.configure(enabled=True)
+
+    if len(args) == 0 and input_path is None:
+        raise ValueError('no terms given. I need a search term pal.')
+
+    try:
+        run(args, input_path, checkpoint, out_path)
+    finally:
+        if profile:
+            print('\n' + metrics.report() + '\n')
+        if profile_out:
+            metrics.dump(profile_out)
+
 
-        print('\n' + '\n\n'.join(accumulator) + '\n')
+# Initialize!
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+'''
+Writing lookups to definitions.txt, or to JSONL, CSV or Anki TSV files.
+
+Records are buffered and written in batches, opening the file once
+per batch. Every batch, and every clear or cut, holds an advisory lock
+on a side file in the data directory, so several CLI processes can
+share the file without their records interleaving. Clearing swaps in
+an empty file with a rename. No writer holds the file open between
+batches, so the rename works on Windows too.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+
+import cache
+import metrics
+from scraper import FOUND, NOT_FOUND, NOT_FOUND_CACHED, ERROR
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+# Lock files are kept in the data directory rather than next to the
+# output, one per output file
+def lock_path(path):
+    key = hashlib.sha1(
+        os.path.normcase(os.path.abspath(path)).encode('utf-8')
+    ).hexdigest()
+    return os.path.join(cache.data_dir(), 'locks', key + '.lock')
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = lock_path(path)
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.f = open(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            # LK_LOCK gives up after ten tries, so keep trying
+            while True:
+                try:
+                    self.f.seek(0)
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+
+
+class OutputFile:
+    # Name the file gets when no path is given
+    default_path = None
+
+    def __init__(self, path=None, flush_every=20, flush_interval=2.0):
+        self.path = path or self.default_path
+        # Write once this many records are waiting, or this many
+        # seconds have passed since the last write
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.flushed_at = time.monotonic()
+        # Fail on an unwritable path now rather than at the first batch
+        open(self.path, 'ab').close()
+
+    # Queues a finished lookup, if this format has a place for it
+    def add(self, result):
+        if result.status in self.statuses:
+            self.write(result)
+
+    def write(self, record):
+        self.pending.append(record)
+        if (len(self.pending) >= self.flush_every or
+                time.monotonic() - self.flushed_at >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.monotonic()
+        if not self.pending:
+            return
+
+        # Opened afresh for each batch, so a file that was cleared or
+        # cut in the meantime is simply the one written to
+        with metrics.timed('write'), FileLock(self.path), \
+                open(self.path, 'ab') as f:
+            empty = os.fstat(f.fileno()).st_size == 0
+            f.write(self.render(self.pending, empty).encode('utf-8'))
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# The classic output: the html of every entry found
+class DefinitionsFile(OutputFile):
+    default_path = 'definitions.txt'
+    statuses = (FOUND,)
+
+    def add(self, result):
+        if result.status in self.statuses:
+            self.write(result.html)
+
+    def render(self, pending, empty):
+        chunks = []
+        for txt in pending:
+            # The first entry in the file goes in without a <div>
+            if empty:
+                chunks.append(txt)
+                empty = False
+            else:
+                chunks.append('\n\n<div>' + txt + '</div>')
+        return ''.join(chunks)
+
+
+# Flattens a lookup into the fields the structured formats share
+def record(result):
+    entry = result.definition or {}
+    return {
+        'term': result.term,
+        'dictionary': result.jisho,
+        'status': result.status,
+        'yomigana': entry.get('yomigana', ''),
+        'definitions': [
+            d for e in result.entries for d in e['definitions']
+        ],
+        'html': result.html or '',
+        'error': str(result.error) if result.error else '',
+    }
+
+
+# One JSON object per line, for every lookup
+class JsonlFile(OutputFile):
+    default_path = 'definitions.jsonl'
+    statuses = (FOUND, NOT_FOUND, NOT_FOUND_CACHED, ERROR)
+
+    def render(self, pending, empty):
+        return ''.join(
+            json.dumps(record(r), ensure_ascii=False) + '\n' for r in pending
+        )
+
+
+# Spreadsheet-friendly, for every lookup; definitions go one per line
+# inside their cell
+class CsvFile(OutputFile):
+    default_path = 'definitions.csv'
+    statuses = (FOUND, NOT_FOUND, NOT_FOUND_CACHED, ERROR)
+    columns = ('term', 'dictionary', 'status', 'yomigana', 'definitions',
+               'html', 'error')
+
+    def render(self, pending, empty):
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        if empty:
+            writer.writerow(self.columns)
+        for r in pending:
+            row = record(r)
+            row['definitions'] = '\n'.join(row['definitions'])
+            writer.writerow([row[c] for c in self.columns])
+        return buf.getvalue()
+
+
+# Ready for File > Import in Anki, as notes of the note type in the
+# bundled card layout with the term in Front and the entry html (which
+# has the yomigana) in Definitions. Back is for the card's English
+# translation, so it is left empty. The header lines tell Anki the
+# separator, note type and columns; older versions skip them as
+# comments.
+class AnkiTsvFile(OutputFile):
+    default_path = 'definitions.tsv'
+    statuses = (FOUND,)
+    header = (
+        '#separator:tab\n'
+        '#html:true\n'
+        '#notetype:DefinitionScraperNoteType\n'
+        '#columns:Front\tBack\tDefinitions\n'
+    )
+
+    def render(self, pending, empty):
+        lines = [self.header] if empty else []
+        for r in pending:
+            fields = [r.term, '', r.html]
+            # Tabs and line breaks would split the note; the html
+            # doesn't need its line breaks
+            lines.append('\t'.join(
+                f.replace('\t', ' ').replace('\n', '') for f in fields
+            ) + '\n')
+        return ''.join(lines)
+
+
+FORMATS = {
+    'html': DefinitionsFile,
+    'jsonl': JsonlFile,
+    'csv': CsvFile,
+    'tsv': AnkiTsvFile,
+}
+
+
+def _replace(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def read(path='definitions.txt'):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8')
+    except FileNotFoundError:
+        return ''
+
+
+def clear(path='definitions.txt'):
+    with FileLock(path):
+        _replace(path, b'')
+
+
+# Hands the file's contents to `copy` and then empties it, with no
+# entry from another process slipping in between. If copying fails
+# the file is left alone.
+def cut(copy, path='definitions.txt'):
+    with FileLock(path):
+        copy(read(path))
+        _replace(path, b'')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+Local lookup service, so several tools can share one warm session,
+cache and rate limit instead of each scraping weblio on its own.
+
+    GET  /lookup?term=言葉&dict=daijirin[,wikipedia]&pick=first
+    POST /lookup   {"terms": [...], "dict": "daijirin", "pick": "first"}
+    GET  /health   status and uptime as JSON
+    GET  /metrics  phase timings and counters in the Prometheus format
+
+Both lookup endpoints answer {"results": [...]}, one record per term
+and dictionary, in the same shape as the JSONL output format. Lookups
+of the same term that arrive at the same time share one fetch and one
+parse, and a POST looks its terms up on a pool of workers.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+import output
+import scraper
+import session
+from jisho_config import jisho_config
+
+# Nobody is around to pick between headings, so only these can be asked for
+PICKS = {
+    'first': scraper.PICK_FIRST,
+    'all': scraper.PICK_ALL,
+    'match-reading': scraper.PICK_MATCH_READING,
+}
+
+# Terms in one POST, so a single client can't tie up the server
+MAX_BATCH = 1000
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def dictionaries(value):
+    value = str(value or 'daijirin')
+    jishos = tuple(d.strip() for d in value.split(',') if d.strip())
+    unknown = [d for d in jishos if d not in jisho_config]
+    if unknown or not jishos:
+        raise BadRequest('unknown dict: ' + value)
+    return jishos
+
+
+def pick_policy(value):
+    value = str(value or 'first')
+    if value not in PICKS:
+        raise BadRequest('unknown pick: ' + value)
+    return PICKS[value]
+
+
+class LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        metrics.count('http_requests')
+
+        try:
+            if url.path == '/lookup':
+                if not query.get('term', '').strip():
+                    raise BadRequest('term is missing')
+                results = scraper.lookup_all(
+                    query['term'], dictionaries(query.get('dict')),
+                    choose=pick_policy(query.get('pick'))
+                )
+                self.send_json(200, {
+                    'results': [output.record(r) for r in results]
+                })
+            elif url.path == '/health':
+                self.send_json(200, {
+                    'status': 'ok',
+                    'uptime_s': time.monotonic() - self.server.started,
+                })
+            elif url.path == '/metrics':
+                self.send_text(200, metrics.to_prometheus(),
+                               'text/plain; version=0.0.4')
+            else:
+                self.send_json(404, {'error': 'not found'})
+        except BadRequest as e:
+            self.send_json(400, {'error': str(e)})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        metrics.count('http_requests')
+
+        try:
+            if url.path != '/lookup':
+                self.send_json(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                raise BadRequest('bad Content-Length')
+            if length < 0:
+                raise BadRequest('bad Content-Length')
+            try:
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                terms = body['terms']
+            except (ValueError, KeyError, TypeError):
+                raise BadRequest('expected {"terms": [...]}')
+            if (not isinstance(terms, list) or
+                    not all(isinstance(t, str) for t in terms)):
+                raise BadRequest('terms must be a list of strings')
+            terms = [t for t in terms if t.strip()]
+            if len(terms) > MAX_BATCH:
+                raise BadRequest(
+                    'at most {} terms per request'.format(MAX_BATCH))
+
+            lookups = scraper.iter_lookups(
+                terms, dictionaries(body.get('dict')),
+                concurrency=self.server.jobs,
+                choose=pick_policy(body.get('pick')), ordered=True
+            )
+            self.send_json(200, {'results': [
+                output.record(r) for results in lookups for r in results
+            ]})
+        except BadRequest as e:
+            # The body may not have been read, so the connection can't
+            # carry another request
+            self.close_connection = True
+            self.send_json(400, {'error': str(e)})
+
+    def send_json(self, status, data):
+        self.send_text(status, json.dumps(data, ensure_ascii=False),
+                       'application/json; charset=utf-8')
+
+    def send_text(self, status, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LookupServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=8750, jobs=4):
+        super().__init__((host, port), LookupHandler)
+        self.jobs = jobs
+        self.started = time.monotonic()
+
+
+def serve(host='127.0.0.1', port=8750, jobs=4):
+    metrics.configure(enabled=True)
+    # Pay for the imports and the first tree before the first client
+    session.get_session()
+    scraper.make_soup(b'')
+
+    with LookupServer(host, port, jobs) as server:
+        print('Serving lookups on http://{0}:{1}/'.format(
+            *server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+'''
+Shared HTTP session for talking to weblio.
+
+Every lookup in the process goes through one pooled keep-alive
+session, so only the first request to www.weblio.jp pays for the
+TCP and TLS handshakes. Transient failures (5xx, 429 and dropped
+connections) are retried with exponential backoff and jitter, and
+every attempt waits its turn with the host's rate limiter.
+
+Bodies are read in chunks by read_until(), which can stop as soon as
+the caller has what it needs. Responses come gzip compressed, or
+brotli compressed when the brotli package is installed, as requests
+asks for whatever urllib3 can decode.
+
+
+License: GNU AGPLv3 or later <https://www.gnu.org/licenses/agpl.html>
+'''
+
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+try:
+    from . import metrics
+    from . import ratelimit
+except ImportError:
+    import metrics
+    import ratelimit
+
+WEBLIO_URL = 'https://www.weblio.jp'
+
+settings = {
+    # Max number of keep-alive connections kept open per host
+    'pool_size': 10,
+    # Seconds to wait for the connection / for the server to respond
+    'connect_timeout': 5,
+    'read_timeout': 15,
+    # Retries after the first attempt, and the backoff between them
+    'retries': 3,
+    'backoff_base': 0.5,
+    'backoff_max': 8,
+}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Statuses whose body is weblio's answer: the page, or its page saying
+# there is no such entry
+ANSWERED = (200, 404)
+
+# Bytes of the (decompressed) body read at a time by read_until()
+CHUNK_SIZE = 16 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# Changes any of the settings above and drops the current session
+# so the next request is made with the new ones
+def configure(**kwargs):
+    global _session
+
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError('unknown session setting: {}'.format(key))
+        if value is not None:
+            settings[key] = value
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+# requests is imported here rather than at the top, as it is slow to
+# import and commands that never go online shouldn't wait for it
+def get_session():
+    global _session
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings['pool_size'],
+                # Retries are handled in fetch() so they can use jitter
+                max_retries=0,
+            )
+            s = requests.Session()
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            _session = s
+        return _session
+
+
+# Full jitter: a random wait between zero and the exponential cap
+def backoff_delay(attempt):
+    cap = min(
+        settings['backoff_max'], settings['backoff_base'] * (2 ** attempt)
+    )
+    return random.uniform(0, cap)
+
+
+# Honors the server's Retry-After (in seconds) if it sent one
+def retry_after(response):
+    try:
+        return min(
+            float(response.headers['Retry-After']), settings['backoff_max']
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+# With `stream` only the headers are read; the body is left for
+# read_until(). The request keeps its place among the host's requests
+# in flight until its body is read, so hand it to read_until() or
+# close().
+def fetch(url, headers=None, stream=False):
+    import requests
+
+    timeout = (settings['connect_timeout'], settings['read_timeout'])
+    limiter = ratelimit.for_host(urlsplit(url).netloc)
+    attempt = 0
+
+    while True:
+        with metrics.timed('rate_wait'):
+            limiter.acquire()
+        start = time.monotonic()
+        response = None
+        metrics.count('requests')
+        try:
+            response = get_session().get(
+                url, headers=headers, timeout=timeout, stream=stream
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            # Connection resets and timeouts are worth another try
+            if attempt >= settings['retries']:
+                raise
+            metrics.count('retries')
+            with metrics.timed('backoff'):
+                time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        finally:
+            # Includes DNS, connecting and TLS when there was no
+            # pooled connection to reuse
+            metrics.record('request', time.monotonic() - start)
+            if response is None:
+                limiter.release(None, time.monotonic() - start)
+
+        if (response.status_code in RETRY_STATUSES and
+                attempt < settings['retries']):
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            limiter.release(
+                response.status_code, time.monotonic() - start,
+                retry_after(response)
+            )
+            response.close()
+            metrics.count('retries')
+            with metrics.timed('backoff'):
+                time.sleep(delay)
+            attempt += 1
+            continue
+
+        # Released by close(), so the download counts towards the
+        # host's in-flight cap and its latency
+        response.slot = (limiter, start)
+        if not stream:
+            close(response)
+        return response
+
+
+# Raises requests.HTTPError for a response that isn't one of ANSWERED
+# (or a 304), such as a 429 or 5xx that outlasted the retries, so it
+# fails the lookup instead of passing for a page with nothing on it
+def check(response):
+    import requests
+
+    if response.status_code not in ANSWERED + (304,):
+        close(response)
+        raise requests.HTTPError(
+            '{0} {1} for {2}'.format(
+                response.status_code, response.reason, response.url),
+            response=response
+        )
+    return response
+
+
+# Closes a response from fetch() and gives back its in-flight slot
+def close(response):
+    response.close()
+    slot = getattr(response, 'slot', None)
+    if slot is not None:
+        response.slot = None
+        limiter, start = slot
+        limiter.release(
+            response.status_code, time.monotonic() - start,
+            retry_after(response)
+        )
+
+
+# Reads a streamed response's body until done(body so far) is true or
+# the body ends, then closes the response. A response read to the end
+# hands its connection back to the pool; one stopped early drops it.
+def read_until(response, done=None):
+    body = bytearray()
+    try:
+        with metrics.timed('download'):
+            for chunk in response.iter_content(CHUNK_SIZE):
+                body += chunk
+                if done is not None and done(body):
+                    metrics.count('downloads_stopped_early')
+                    break
+    finally:
+        close(response)
+    metrics.count('bytes', len(body))
+    return bytes(body)
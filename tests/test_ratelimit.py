@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Back-off and recovery of the per-host rate limiter.
+
+    python -m pytest tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ratelimit
+
+
+def limiter(**kwargs):
+    settings = dict(ratelimit.settings, **kwargs)
+    return ratelimit.HostLimiter(**settings)
+
+
+# Sends one request and answers it with `status`, leaving the limiter
+# free to back off again straight away
+def answer(lim, status, latency=0.1):
+    lim.backed_off_at = 0.0
+    lim.in_flight += 1
+    lim.release(status, latency)
+
+
+class BackOffTest(unittest.TestCase):
+    def test_halves_on_429_and_5xx(self):
+        lim = limiter(rate=2.0, min_rate=0.2)
+        answer(lim, 429)
+        self.assertEqual(lim.rate, 1.0)
+        answer(lim, 503)
+        self.assertEqual(lim.rate, 0.5)
+        answer(lim, None)
+        self.assertEqual(lim.rate, 0.25)
+        answer(lim, 500)
+        self.assertEqual(lim.rate, 0.2)
+
+    def test_once_per_round_trip(self):
+        lim = limiter(rate=2.0)
+        lim.in_flight = 2
+        lim.release(429, 0.1)
+        lim.release(429, 0.1)
+        self.assertEqual(lim.rate, 1.0)
+
+    def test_never_above_a_rate_below_min_rate(self):
+        lim = limiter(rate=0.1, min_rate=0.2)
+        answer(lim, 429)
+        self.assertLessEqual(lim.rate, lim.max_rate)
+        self.assertEqual(lim.rate, 0.1)
+
+    def test_recovers_up_to_the_configured_rate(self):
+        lim = limiter(rate=2.0, recover_step=0.5)
+        answer(lim, 429)
+        answer(lim, 429)
+        self.assertEqual(lim.rate, 0.5)
+        for expected in (1.0, 1.5, 2.0, 2.0):
+            answer(lim, 200)
+            self.assertEqual(lim.rate, expected)
+
+    def test_slow_responses_back_off(self):
+        lim = limiter(rate=2.0, latency_factor=3.0)
+        answer(lim, 200, latency=0.1)
+        # The smoothed latency passes three times the baseline
+        for _ in range(10):
+            answer(lim, 200, latency=2.0)
+        self.assertLess(lim.rate, 2.0)
+
+
+class ConfigureTest(unittest.TestCase):
+    def tearDown(self):
+        ratelimit.configure(rate=2.0, min_rate=0.2)
+
+    def test_rejects_rates_that_are_not_positive(self):
+        for rate in (0, -1):
+            with self.assertRaises(ValueError):
+                ratelimit.configure(rate=rate)
+
+
+if __name__ == '__main__':
+    unittest.main()